@@ -0,0 +1,290 @@
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+from ndjson_decoder import coalesce
+from ollama_client import OllamaStream, iter_batches
+from single_flight import Flight
+from story_index import StoryIndex
+from story_store import StoryStore
+from story_tree import TreeNode, build_path_from_prompt, build_path_from_nodes
+from threat_manager import ThreatManager, ThreatSnapshotTable
+
+
+def make_token_lines(count):
+    lines = []
+    for i in range(count):
+        chunk = {"model": "mistral", "created_at": "2024-01-01T00:00:00Z", "response": f" token{i}", "done": False}
+        lines.append(json.dumps(chunk).encode("utf-8") + b"\n")
+    return lines
+
+
+class ChunkReader:
+    # Hands out one pre-split chunk per read, the way a socket delivers a streamed token.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, amt=None):
+        return next(self.chunks, b"")
+
+
+def make_response(chunks):
+    response = requests.Response()
+    response.raw = ChunkReader(chunks)
+    response.status_code = 200
+    return response
+
+
+def iter_lines_path(chunks):
+    text = ""
+    for line in make_response(chunks).iter_lines():
+        if line:
+            text += json.loads(line.decode('utf-8'))['response']
+    return text
+
+
+def group_reads(lines, tokens_per_read):
+    return [b"".join(lines[i:i + tokens_per_read]) for i in range(0, len(lines), tokens_per_read)]
+
+
+def shipped_batches(chunks):
+    # What OllamaClient.generate_batches yields for a response: one coalesced batch per read.
+    for objects in iter_batches(make_response(chunks)):
+        yield objects if len(objects) == 1 else list(coalesce(objects))
+
+
+def shipped_path(chunks):
+    # The path a narration takes in the app: the pump thread of a coalesced flight decodes the
+    # response and the window reads it through a subscription.
+    flight = Flight(None, shipped_batches(chunks), lambda flight: None)
+    stream = OllamaStream(flight.subscribe())
+    flight.thread.start()
+    text = "".join(stream)
+    flight.thread.join()
+    return text
+
+
+def lagging_shipped_path(chunks):
+    # The same path when the window falls behind: the pump has buffered everything before the
+    # subscriber reads again.
+    flight = Flight(None, shipped_batches(chunks), lambda flight: None)
+    stream = OllamaStream(flight.subscribe())
+    flight.pump()
+    return "".join(stream)
+
+
+def bench_ndjson_decoding(token_count=20000, repeat=5):
+    lines = make_token_lines(token_count)
+    # requests hands over one read per token while the reader keeps up. When the process is
+    # busy, several tokens are waiting on the socket by the time it reads again.
+    cases = [
+        ("one token per read", "iter_lines + decode + json.loads", iter_lines_path, lines),
+        ("one token per read", "decoder + pump thread + subscriber", shipped_path, lines),
+        ("16 tokens per read", "iter_lines + decode + json.loads", iter_lines_path, group_reads(lines, 16)),
+        ("16 tokens per read", "decoder + pump thread + subscriber", shipped_path, group_reads(lines, 16)),
+        ("16 tokens per read", "same, subscriber lagging", lagging_shipped_path, group_reads(lines, 16)),
+    ]
+    expected = iter_lines_path(lines)
+    print(f"NDJSON decoding, {token_count} tokens, CPU time of all threads, best of {repeat}:")
+    for reads, name, function, chunks in cases:
+        best = None
+        for _ in range(repeat):
+            start = time.process_time()
+            result = function(chunks)
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert result == expected
+        print(f"  {reads:<20} {name:<36} {best / token_count * 1e6:8.2f} us/token")
+
+
+def make_story_chain(depth):
+    node = TreeNode("You are standing inside a mysterious dungeon.", "Start")
+    for i in range(depth - 1):
+        child = TreeNode(f"Scene {i}: the corridor narrows and torches flicker along the damp walls. "
+                         "What will you do? 1) Follow the sound 2) Inspect the torches 3) Turn back", f"choice {i}")
+        node.add_child(child)
+        node = child
+    return node
+
+
+def concatenated_path_prompt(path):
+    # The original build_path_from_prompt, one += per line.
+    prompt = "Here is the full story path so far for your context:\n"
+    for i, (state, choice, _) in enumerate(path):
+        if i == 0 and choice.lower() == "start":
+            prompt += f"{state}\n"
+        else:
+            prompt += f"The player was presented with this situation:\n{state.strip()}\n"
+            prompt += f"The player responded with: {choice.strip()}\n"
+    prompt += "\nThis is the story context to keep in mind. Now, continue the story based on the latest player choice and the current situation.\n"
+    return prompt
+
+
+def bench_path_prompt(depths=(10, 100, 1000, 10000), repeat=5):
+    print(f"Full path prompt build, best of {repeat}:")
+    for depth in depths:
+        leaf = make_story_chain(depth)
+        cases = [
+            ("getPath + += concatenation", lambda: concatenated_path_prompt(leaf.getPath())),
+            ("getPath + single join", lambda: build_path_from_prompt(leaf.getPath())),
+            ("cached node segments", lambda: build_path_from_nodes(leaf.path_nodes())),
+        ]
+        expected = concatenated_path_prompt(leaf.getPath())
+        for name, function in cases:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = function()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            assert result == expected
+            print(f"  depth {depth:>6}  {name:<28} {best * 1e3:9.3f} ms")
+
+
+def bench_story_index(node_count=10000, repeat=50):
+    # Word frequencies follow Zipf's law, as in real narration: a few words appear in most
+    # scenes and make up most of the postings a query walks.
+    random.seed(0)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    leaf = TreeNode("You are standing inside a mysterious dungeon.", "Start")
+    for _ in range(node_count - 1):
+        child = TreeNode(" ".join(random.choices(vocabulary, weights, k=80)) + " The corridor narrows. What will you do?",
+                         "I take the " + random.choices(vocabulary, weights)[0])
+        leaf.add_child(child)
+        leaf = child
+    index = StoryIndex()
+    start = time.perf_counter()
+    for node in leaf.path_nodes():
+        index.add(node)
+    add_time = (time.perf_counter() - start) / node_count
+    queries = ["I use the {} on the {} near the {}".format(*random.choices(vocabulary, weights, k=3)) for _ in range(repeat)]
+    print(f"Story index, {node_count} scenes:")
+    print(f"  {'add':<28} {add_time * 1e6:9.1f} us/scene")
+    # The window recalls with a minimum score of 1.0; 0 ranks every scene sharing a word.
+    for min_score in (0.0, 1.0):
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query, 3, exclude=(leaf, leaf.parent), min_score=min_score)
+        search_time = (time.perf_counter() - start) / repeat
+        print(f"  {f'search, min_score {min_score}':<28} {search_time * 1e3:9.3f} ms/query")
+
+
+class DictTreeNode:
+    # The tree node as it was before __slots__ and snapshot ids, for comparison.
+    def __init__(self, state, choice, threat_state=None, parent=None):
+        self.state = state
+        self.choice = choice
+        self.threat_state = threat_state
+        self.children = []
+        self.parent = parent
+        self.context = None
+        self.speculative_children = None
+        self.telemetry = None
+
+    def add_child(self, child_node):
+        child_node.parent = self
+        self.children.append(child_node)
+
+
+def grow_dict_nodes(threat_manager, states, choices):
+    root = node = DictTreeNode(states[0], "Start")
+    for state, choice in zip(states, choices):
+        threat_state = {
+            "turn_counter": threat_manager.turn_counter,
+            "last_threat": threat_manager.last_threat,
+            "enemy_revealed": threat_manager.enemy_revealed,
+            "enemy_profile": threat_manager.enemy_profile,
+            "enemy_defeated": threat_manager.enemy_defeated
+        }
+        child = DictTreeNode(state, choice, threat_state=threat_state)
+        node.add_child(child)
+        node = child
+        threat_manager.turn_counter += 1
+    return root
+
+
+def grow_slot_nodes(threat_manager, states, choices):
+    snapshots = ThreatSnapshotTable()
+    root = node = TreeNode(states[0], "Start")
+    for state, choice in zip(states, choices):
+        child = TreeNode(state, choice, threat_id=snapshots.capture(threat_manager), turn_counter=threat_manager.turn_counter)
+        node.add_child(child)
+        node = child
+        threat_manager.turn_counter += 1
+    return root, snapshots
+
+
+def bench_node_memory(node_count=10000):
+    # Narration text and player input are allocated up front, so only the tree's own overhead is
+    # measured; the player input arrives as fresh strings, as it does from the text box.
+    states = [f"Scene {i}: the corridor narrows." for i in range(node_count)]
+    choices = ["".join(["I go ", "left"]) for _ in range(node_count)]
+    print(f"Tree node memory, {node_count} nodes (tracemalloc):")
+    for name, grow in (("dict nodes + threat dicts", grow_dict_nodes), ("slotted nodes + snapshot ids", grow_slot_nodes)):
+        threat_manager = ThreatManager()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tree = grow(threat_manager, states, choices)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"  {name:<30} {(after - before) / node_count:8.1f} bytes/node")
+        del tree
+
+
+def bench_store_open(node_count=1000000):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "story.db")
+    store = StoryStore(path)
+    session = store.create_session()
+    start = time.perf_counter()
+    # A single storyline: row i sits at depth i - 1 and its jump pointer follows TreeNode.link_to.
+    jumps = [0]
+    for depth in range(1, node_count):
+        parent_jump = jumps[depth - 1]
+        same_span = depth - 1 - parent_jump == parent_jump - jumps[parent_jump]
+        jumps.append(jumps[parent_jump] if same_span else depth - 1)
+    rows = ((i, session, i - 1 if i > 1 else None, "I go left" if i > 1 else "Start",
+             f"Scene {i}: the corridor narrows and torches flicker along the damp walls.", None, None, i,
+             i - 1, jumps[i - 1] + 1)
+            for i in range(1, node_count + 1))
+    with store.reader:
+        store.reader.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        store.reader.execute("UPDATE sessions SET head = ? WHERE id = ?", (node_count, session))
+    build_time = time.perf_counter() - start
+    store.close()
+
+    start = time.perf_counter()
+    store = StoryStore(path)
+    head, _ = store.open_session(store.latest_session())
+    recent = [head.state]
+    node = head
+    for _ in range(19):
+        node = node.parent
+        recent.append(node.state)
+    open_time = time.perf_counter() - start
+    start = time.perf_counter()
+    root = head.ancestor_at_depth(0)
+    lookup_time = time.perf_counter() - start
+    assert root.choice == "Start" and root.parent is None
+    store.close()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    print(f"Story store, {node_count} node session:")
+    print(f"  {'write':<26} {build_time * 1e3:9.1f} ms")
+    print(f"  {'open + last 20 turns':<26} {open_time * 1e3:9.1f} ms")
+    print(f"  {'cold ancestor_at_depth(0)':<26} {lookup_time * 1e3:9.1f} ms")
+
+
+if __name__ == "__main__":
+    bench_ndjson_decoding()
+    bench_path_prompt()
+    bench_story_index()
+    bench_node_memory()
+    bench_store_open()
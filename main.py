@@ -1,13 +1,45 @@
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QTextEdit, QPushButton, 
                              QVBoxLayout, QHBoxLayout, QWidget, QScrollArea, QLabel, QSizePolicy, QLineEdit)
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
 from PyQt6.QtGui import QKeyEvent
-from story_tree import TreeNode, build_path_from_prompt, build_current_prompt, system_prompt, query_ollama_streaming
-from story_queue import add_to_queue, get_priority_memory, clear_priority_memory, list_priority_memory
-from threat_manager import ThreatManager
+from story_tree import TreeNode, build_current_prompt, build_choice_prompt, split_path_at_summary, path_between, system_prompt, query_ollama_streaming, parse_choices, ThirdChoiceDetector, record_choice_cutoff
+from story_queue import add_to_queue, get_priority_memory, clear_priority_memory, list_priority_memory, restore_priority_memory
+from threat_manager import ThreatManager, ThreatSnapshotTable
+from ollama_client import OllamaClient, OllamaError
+from response_cache import ResponseCache
+from speculation import SpeculativeGenerator
+from summarizer import RollingSummarizer
+from story_index import StoryIndex
+from path_view import PathView
+from story_store import StoryStore
+from story_gc import BranchArchiver
+from single_flight import CoalescingClient
+from prompt_builder import PromptAssembler, ContextBuilder
+import copy
+import requests
 import sys
+import threading
 import re
 
+# Narrations are routed to the least busy of these Ollama servers.
+OLLAMA_BACKENDS = ["http://localhost:11434"]
+
+OPENING_SCENE = ("You are standing inside a mysterious dungeon. Behind you was the entrance of the dungeon that has bee closed now. You have three paths in front of you"
+                 "\n\n1) Moved forward which leads to a passage into dark hallways"
+                 "\n2) Move to your left, is a staircase that leads downwards"
+                 "\n3) Move to your right is a room, with a statue of a gargoyle"
+                 "\n\nThe decision is yours to make.")
+
+FIXED_PROMPT_SECTIONS = {
+    "system": system_prompt + "\n\n",
+    "rules": "Do NOT introduce any enemies in the narrative unless explicitly instructed in the 'Enemy Information' section. "
+    "Focus on the dungeon environment and the player's actions, ensuring the scene aligns with the current context.\n\n",
+    "closing": "Describe the scene and the effects of the player's action without resolving the outcome or making decisions. "
+    "If the player's action does not use a weakness when an enemy is present, describe its failure and repeat the hint. "
+    "Do NOT introduce new enemies or conclude the encounter until the player uses a weakness to defeat the current enemy. "
+    "Always provide exactly three action options at the end of your response.\n\n",
+}
+
 class CustomTextEdit(QTextEdit):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -20,6 +52,8 @@ class CustomTextEdit(QTextEdit):
             super().keyPressEvent(event)
 
 class AIDungeonMasterChat(QMainWindow):
+    warm_up_finished = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("AI Dungeon Master Chat")
@@ -27,14 +61,41 @@ class AIDungeonMasterChat(QMainWindow):
         self.resize(800, 600)
 
         self.threat_manager = ThreatManager()
+        self.ollama_client = CoalescingClient(OllamaClient(base_urls=OLLAMA_BACKENDS, cache=ResponseCache()))
+        # Pin "seed" or set "temperature" to 0 here to make narrations replayable from the cache.
+        # Any Ollama option (num_predict, num_ctx, stop, ...) is sent with every request. num_ctx
+        # is set explicitly so the prompt budget below matches the window Ollama really uses.
+        self.generation_options = {"num_predict": 768, "num_ctx": 4096}
+        # Ends the stream once the third numbered option is complete instead of letting the model ramble.
+        self.enforce_choice_cutoff = True
+        self.speculator = SpeculativeGenerator(self.ollama_client)
+        # Every request uses the same num_ctx; a different one makes Ollama reload the model.
+        self.summarizer = RollingSummarizer(self.ollama_client, on_summary=self.store_summary, options={
+            "num_predict": 256, "temperature": 0.2, "num_ctx": self.generation_options["num_ctx"]})
+        self.summary_raw_turns = 3
+        self.prompt_assembler = PromptAssembler()
+        self.context_builder = ContextBuilder(
+            token_budget=self.generation_options["num_ctx"] - self.generation_options["num_predict"])
+        # A reused context counts against the same window; once it leaves less than this many
+        # tokens for the new prompt, the prompt is sent fresh instead.
+        self.min_prompt_tokens = 512
+        self.last_context_report = None
+        self.story_index = StoryIndex()
+        self.recall_count = 3
+        self.recall_min_score = 1.0
+        self.session_id = 0
         self.include_full_path = False
-        self.current_node = TreeNode("You are standing inside a mysterious dungeon. Behind you was the entrance of the dungeon that has bee closed now. You have three paths in front of you"
-                                     "\n\n1) Moved forward which leads to a passage into dark hallways"
-                                     "\n2) Move to your left, is a staircase that leads downwards"
-                                     "\n3) Move to your right is a room, with a statue of a gargoyle"
-                                     "\n\nThe decision is yours to make.", "Start")
+        self.story_store = StoryStore()
+        self.resume_turns = 20
+        self.archiver = BranchArchiver(self.story_store)
+        session = self.story_store.latest_session()
+        if session is None:
+            self.start_session()
+        else:
+            self.resume_session(session)
         self.message_widgets = []
         self.stop_streaming = False
+        self.active_stream = None
 
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -164,16 +225,68 @@ class AIDungeonMasterChat(QMainWindow):
         """)
         refresh_button.clicked.connect(self.refresh_prompt)
 
+        branch_buttons = []
+        for text, step in (("◀ Branch", -1), ("Branch ▶", 1)):
+            branch_button = QPushButton(text)
+            branch_button.setFixedWidth(90)
+            branch_button.setStyleSheet("""
+                QPushButton {
+                    background-color: #9C27B0;
+                    color: white;
+                    border-radius: 5px;
+                    padding: 5px;
+                    font-size: 14px;
+                }
+                QPushButton:hover {
+                    background-color: #8E24AA;
+                }
+            """)
+            branch_button.clicked.connect(lambda _, step=step: self.switch_branch(step))
+            branch_buttons.append(branch_button)
+
         
         button_layout.addWidget(send_button)
         button_layout.addWidget(clear_button)
         button_layout.addWidget(show_memory_button)
         button_layout.addWidget(refresh_button)
+        for branch_button in branch_buttons:
+            button_layout.addWidget(branch_button)
         button_layout.addStretch()
+
+        self.tokens_per_second_label = QLabel("")
+        self.tokens_per_second_label.setStyleSheet("QLabel { color: #BBBBBB; font-size: 12px; }")
+        button_layout.addWidget(self.tokens_per_second_label)
+
+        self.model_status_label = QLabel("⏳ Loading model...")
+        self.model_status_label.setStyleSheet("QLabel { color: #FFC107; font-size: 12px; }")
+        button_layout.addWidget(self.model_status_label)
         main_layout.addLayout(button_layout)
 
         self.chat_layout.addStretch()
-        self.add_message(self.current_node.state, is_user=False)
+        self.show_recent_turns()
+
+        self.warm_up_finished.connect(self.on_warm_up_finished)
+        self.ollama_client.start_health_checks()
+        threading.Thread(target=self.warm_up_model, daemon=True).start()
+
+    def warm_up_model(self):
+        try:
+            result = self.ollama_client.warm_up(options={"num_ctx": self.generation_options["num_ctx"]})
+        except Exception as error:
+            result = error
+        self.warm_up_finished.emit(result)
+
+    def on_warm_up_finished(self, results):
+        if isinstance(results, Exception):
+            self.model_status_label.setText("⚠️ Model unavailable")
+            self.model_status_label.setStyleSheet("QLabel { color: #FF4C4C; font-size: 12px; }")
+            return
+        # load_duration is reported in nanoseconds; near zero means the model was already resident.
+        load_seconds = max(result.get("load_duration", 0) for result in results) / 1e9
+        backend_count = len(self.ollama_client.backends.backends)
+        self.model_status_label.setText(f"✅ Model ready on {len(results)}/{backend_count} (load {load_seconds:.2f}s)")
+        self.model_status_label.setStyleSheet("QLabel { color: #4CAF50; font-size: 12px; }")
+        self.start_speculation()
 
     def refresh_prompt(self):
         self.include_full_path = True
@@ -181,13 +294,19 @@ class AIDungeonMasterChat(QMainWindow):
 
     def add_memory(self):
         memory_text = self.memory_input.text().strip()
-        if not memory_text:
+        # The streaming narration stores its own context when it ends, which would bring back
+        # the context this clears; the fact stays in the input until the narration is done.
+        if not memory_text or self.narration_in_progress():
             return
         match = re.match(r'^(\d+):\s*(.+)$', memory_text)
         if match:
             priority = int(match.group(1))
             fact = match.group(2).strip()
             add_to_queue(priority, fact)
+            # The current context predates the new fact, so the next prompt is sent in full.
+            self.current_node.context = None
+            self.record_turn(self.current_node)
+            self.story_store.update_snapshot(self.store_session, self.current_node, self.threat_snapshots)
             self.memory_input.clear()
             self.add_message(f"Added memory: {priority}: {fact}", is_user=False)
         else:
@@ -259,44 +378,278 @@ class AIDungeonMasterChat(QMainWindow):
         QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(
             self.scroll_area.verticalScrollBar().maximum()))
 
+    def add_path_view(self, head):
+        title = QLabel("📜 **Story Path So Far**")
+        title.setStyleSheet("QLabel { color: #FFFFFF; font-size: 14px; }")
+        view = PathView(head)
+        view.setMaximumWidth(int(self.width() * 0.7))
+
+        v_layout = QVBoxLayout()
+        v_layout.setContentsMargins(10, 0, 10, 0)
+        v_layout.addWidget(title)
+        v_layout.addWidget(view)
+
+        container = QWidget()
+        container.setLayout(v_layout)
+        container.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Preferred)
+        self.chat_layout.insertWidget(self.chat_layout.count() - 1, container)
+        self.chat_layout.insertSpacing(self.chat_layout.count() - 1, 10)
+        self.message_widgets.append((container, False, None))
+        QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(
+            self.scroll_area.verticalScrollBar().maximum()))
+
+    def narration_in_progress(self):
+        # The streaming narration is written to its own node and chat label when it ends, so the
+        # tree and the chat must stay put until then.
+        if self.active_stream is None:
+            return False
+        self.add_message("Wait for the narration to finish, or press Stop, before moving on.", is_user=False)
+        return True
+
     def delete_message(self, container, node):
-        if not node or not node.parent:
+        if not node or not node.parent or self.narration_in_progress():
+            return
+        self.navigate_to(node.parent)
+        self.archiver.discard(node)
+
+    def navigate_to(self, node):
+        # Moves to any node in the tree. Only the turns below the common ancestor of the old and
+        # new positions are taken off the chat and the retrieval index, and only the new
+        # branch's turns are added.
+        if node is None or node is self.current_node:
             return
-        index = -1
-        for i, (widget, is_user, widget_node) in enumerate(self.message_widgets):
-            if widget == container:
-                index = i
+        self.speculator.release()
+        ancestor, up, down = path_between(self.current_node, node)
+        if ancestor is not None and self.unindexed_turn is not None and ancestor.depth < self.unindexed_turn.depth:
+            # The new branch leaves the path above the turns indexed so far.
+            self.unindexed_turn = ancestor
+        if up:
+            self.archiver.touch(up[-1])
+        for old in up:
+            self.story_index.remove(old)
+        for new in down:
+            self.story_index.add(new)
+        index = self.message_index(up[-1]) if up else len(self.message_widgets)
+        self.current_node = node
+        if ancestor is None or index is None or len(down) > self.resume_turns:
+            self.remove_messages(0)
+            self.show_recent_turns()
+        else:
+            self.remove_messages(index)
+            for new in down:
+                self.show_turn(new)
+        self.restore_snapshot(node)
+        self.story_store.set_head(self.store_session, node)
+        self.start_speculation()
+
+    def switch_branch(self, step):
+        # Steps to the previous or next sibling of the nearest turn that has one, then follows
+        # that branch down to its latest turn.
+        if self.narration_in_progress():
+            return
+        node = self.current_node
+        while node.parent is not None:
+            siblings = self.story_store.load_children(node.parent)
+            if len(siblings) > 1:
                 break
-        if index == -1:
+            node = node.parent
+        else:
+            self.add_message("There is no other branch to switch to.", is_user=False)
             return
-        if index + 1 < len(self.message_widgets) and not self.message_widgets[index + 1][1]:
-            self.chat_layout.removeWidget(self.message_widgets[index + 1][0])
-            self.message_widgets[index + 1][0].deleteLater()
-            self.message_widgets.pop(index + 1)
-        self.chat_layout.removeWidget(container)
-        container.deleteLater()
-        self.message_widgets.pop(index)
-        self.current_node = node.parent
-        self.threat_manager.revert_threat()
-        QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(
-            self.scroll_area.verticalScrollBar().maximum()))
-
-    def clear_messages(self):
-        for widget, is_user, _ in self.message_widgets:
+        target = siblings[(siblings.index(node) + step) % len(siblings)]
+        children = self.story_store.load_children(target)
+        while children:
+            target = children[-1]
+            children = self.story_store.load_children(target)
+        self.navigate_to(target)
+
+    def restore_snapshot(self, node):
+        threat_state = self.threat_snapshots.state_for(node)
+        if threat_state is not None:
+            self.threat_manager.restore(threat_state)
+        restore_priority_memory(self.threat_snapshots.memories_for(node))
+
+    def record_turn(self, node):
+        node.threat_id = self.threat_snapshots.capture(self.threat_manager, list_priority_memory())
+        node.turn_counter = self.threat_manager.turn_counter
+
+    def message_index(self, node):
+        for i, (_, is_user, widget_node) in enumerate(self.message_widgets):
+            if widget_node is node:
+                return i
+        return None
+
+    def remove_messages(self, start):
+        for widget, _, _ in self.message_widgets[start:]:
             self.chat_layout.removeWidget(widget)
             widget.deleteLater()
-        self.message_widgets.clear()
-        self.current_node = TreeNode("You are standing inside a mysterious dungeon. Behind you was the entrance of the dungeon that has bee closed now. You have three paths in front of you"
-                                     "\n\n1) Moved forward which leads to a passage into dark hallways"
-                                     "\n2) Move to your left, is a staircase that leads downwards"
-                                     "\n3) Move to your right is a room, with a statue of a gargoyle"
-                                     "\n\nThe decision is yours to make.", "Start")
+        del self.message_widgets[start:]
+
+    def store_summary(self, node):
+        # Called on the summarizer's thread; the store only queues the write.
+        self.story_store.update_summary(node)
+
+    def start_session(self):
+        self.store_session = self.story_store.create_session()
+        self.threat_snapshots = ThreatSnapshotTable()
+        self.current_node = TreeNode(OPENING_SCENE, "Start")
+        self.unindexed_turn = None
+        self.record_turn(self.current_node)
+        self.story_store.add_node(self.store_session, self.current_node, self.threat_snapshots)
+        self.story_store.set_head(self.store_session, self.current_node)
+        self.story_index.add(self.current_node)
+
+    def resume_session(self, session):
+        self.store_session = session
+        self.current_node, self.threat_snapshots = self.story_store.open_session(session)
+        self.unindexed_turn = None
+        self.restore_snapshot(self.current_node)
+
+    def show_recent_turns(self):
+        nodes = []
+        node = self.current_node
+        while node is not None and len(nodes) < self.resume_turns:
+            nodes.append(node)
+            node = node.parent
+        if node is not None:
+            self.add_message("📜 Earlier turns are not shown here. Type 'show path' to read the whole story.", is_user=False)
+        # The turns before the ones shown are indexed on the next recall.
+        self.unindexed_turn = node
+        for node in reversed(nodes):
+            self.story_index.add(node)
+            self.show_turn(node)
+
+    def index_earlier_turns(self):
+        # Reads the text of every turn from unindexed_turn back to the start in one query,
+        # without keeping it in memory.
+        node = self.unindexed_turn
+        if node is None:
+            return
+        self.unindexed_turn = None
+        states = self.story_store.load_path_states(node) if node.node_id is not None else {}
+        while node is not None:
+            self.story_index.add(node, states.get(node.node_id))
+            node = node.parent
+
+    def show_turn(self, node):
+        if node.parent is not None:
+            self.add_message(node.choice, is_user=True, node=node)
+        self.add_message(node.state, is_user=False)
+
+    def clear_messages(self):
+        if self.narration_in_progress():
+            return
+        self.remove_messages(0)
+        self.speculator.release()
+        self.archiver.end_session(self.current_node, self.store_session)
         self.threat_manager = ThreatManager()
+        self.story_index.clear()
         clear_priority_memory()
+        self.start_session()
+        self.prompt_assembler.forget(self.session_id)
+        self.session_id += 1
         self.add_message(self.current_node.state, is_user=False)
 
+    def closeEvent(self, event):
+        self.ollama_client.close()
+        self.story_store.close()
+        super().closeEvent(event)
+
     def stop_model_response(self):
         self.stop_streaming = True
+        if self.active_stream is not None:
+            self.active_stream.stop()
+
+    def start_speculation(self):
+        node = self.current_node
+        if self.include_full_path or len(parse_choices(node.state)) < 3:
+            return
+        jobs = []
+        for choice in ("1", "2", "3"):
+            # Speculate on a copy so the real threat manager only advances when the player commits.
+            threat_manager = copy.deepcopy(self.threat_manager)
+            threat_manager.advance_threat()
+            if threat_manager.enemy_revealed and threat_manager.enemy_profile and threat_manager.check_defeat(choice):
+                continue
+            jobs.append((choice, *self.build_turn_prompt(TreeNode("", choice, parent=node), threat_manager)))
+        self.speculator.start(node, jobs, self.generation_options)
+
+    def report_dropped_context(self, report):
+        dropped = []
+        if report["dropped_facts"]:
+            dropped.append("memories: " + "; ".join(report["dropped_facts"]))
+        if report["dropped_enemy"]:
+            dropped.append("enemy sections: " + ", ".join(report["dropped_enemy"]))
+        if report["dropped_summary"]:
+            dropped.append("story summary")
+        if report["dropped_recall"]:
+            dropped.append(f"{len(report['dropped_recall'])} recalled scenes")
+        if report["dropped_turns"]:
+            dropped.append(f"{len(report['dropped_turns'])} oldest turns")
+        if dropped:
+            self.add_message(
+                f"✂️ Context budget ({report['used']}/{report['budget']} tokens) left out " + " | ".join(dropped),
+                is_user=False,
+            )
+
+    def build_turn_prompt(self, node, threat_manager, include_full_path=False, session=None, reuse_context=True):
+        # Returns the prompt, the parent's context when it is reused, and then the same turn
+        # written out in full, which a dropped stream is resumed from since raw mode has no context.
+        fixed_sections = FIXED_PROMPT_SECTIONS
+        memory_facts = get_priority_memory()
+
+        path = None
+        current_block = ""
+        context = None
+        summary = None
+        if include_full_path:
+            summary, path = split_path_at_summary(node, self.summary_raw_turns)
+            shown = path
+        else:
+            shown = (node, node.parent)
+            context = node.parent.context if reuse_context else None
+            if context and len(context) > self.context_builder.token_budget - self.min_prompt_tokens:
+                context = None
+            if context:
+                # The parent's context already holds the instructions, the memories and its own
+                # narration, so only the player's choice and this turn's instructions are new.
+                fixed_sections = {}
+                memory_facts = []
+                current_block = build_choice_prompt(node.choice)
+            else:
+                current_block = build_current_prompt(node.parent.state, node.choice)
+
+        fragments = threat_manager.enemy_fragments()
+        transition_block = ""
+        enemy_sections = {"death_rules": fragments.death_rules if fragments else ""}
+        if fragments and threat_manager.enemy_revealed:
+            if threat_manager.turn_counter == threat_manager.last_threat:
+                transition_block = (
+                    f"You are to first transition the envrionment to the domain of the enemy before fully introducing them"
+                    f" You have to transition the current scene to a scene that fits the domain of the enemy. It should be done seamlessly, and the domain of the enemy should not be changed. It should be exactly described."
+                    )
+            enemy_sections["enemy"] = fragments.enemy
+            enemy_sections["enemy_description"] = fragments.information
+        enemy_sections["transition"] = transition_block
+        if context and not threat_manager.enemy_revealed:
+            # Outside an encounter the death rules are unchanged from the ones already in the context.
+            enemy_sections["death_rules"] = ""
+
+        recalled = []
+        if not context:
+            self.index_earlier_turns()
+            # "1", "2" and "3" appear in every scene, so a numbered choice is looked up by its option's text.
+            query = parse_choices(node.parent.state).get(node.choice.strip(), node.choice)
+            recalled = self.story_index.search(query, self.recall_count, exclude=shown, min_score=self.recall_min_score)
+        sections, report = self.context_builder.build(fixed_sections, memory_facts, enemy_sections, path, current_block,
+                                                      summary, recalled, reserved=len(context) if context else 0)
+        if session is not None:
+            self.last_context_report = report
+        # Prefix reuse is tracked for full prompts; a reused context is itself the shared prefix.
+        prompt = self.prompt_assembler.assemble(sections, session if not context else None)
+        if not context:
+            return prompt, None, None
+        return prompt, context, self.build_turn_prompt(node, threat_manager, reuse_context=False)[0]
 
     def send_message(self):
         user_input = self.prompt_input.toPlainText().strip()
@@ -308,27 +661,25 @@ class AIDungeonMasterChat(QMainWindow):
             "story path so far", "path so far", 
             "give me full path so far", "give me full history"
         ]:
-            path = self.current_node.getPath()
-            path_display = "📜 **Story Path So Far**\n\n"
-            for i, (state, choice, _) in enumerate(path):
-                if i == 0:
-                    path_display += f"🌟 Start: {state.strip()}\n\n"
-                else:
-                    path_display += f"🧭 Player chose: {choice.strip()}\n"
-                    path_display += f"📖 Resulting situation:\n{state.strip()}\n\n"
             self.add_message(user_input, is_user=True)
-            self.add_message(path_display.strip(), is_user=False)
+            self.add_path_view(self.current_node)
             self.prompt_input.clear()
             return
 
-        threat_state = {
-            "turn_counter": self.threat_manager.turn_counter,
-            "last_threat": self.threat_manager.last_threat,
-            "enemy_revealed": self.threat_manager.enemy_revealed,
-            "enemy_profile": self.threat_manager.enemy_profile,
-            "enemy_defeated": self.threat_manager.enemy_defeated
-        }
-        new_node = TreeNode("", user_input.strip(), threat_state=threat_state)
+        if self.narration_in_progress():
+            return
+
+        turn_match = re.match(r'^go to turn (\d+)$', user_input.lower())
+        if turn_match:
+            self.prompt_input.clear()
+            target = self.current_node.ancestor_at_depth(int(turn_match.group(1)))
+            if target is None:
+                self.add_message(f"There is no turn {turn_match.group(1)} on this path.", is_user=False)
+            else:
+                self.navigate_to(target)
+            return
+
+        new_node = TreeNode("", user_input.strip())
         self.current_node.add_child(new_node)
         self.add_message(user_input, is_user=True, node=new_node)
         self.current_node = new_node
@@ -338,92 +689,32 @@ class AIDungeonMasterChat(QMainWindow):
 
         enemy = self.threat_manager.enemy_profile
 
-        defeat_message = ""
-        if self.threat_manager.enemy_revealed and enemy:
-            if self.threat_manager.check_defeat(user_input):
-                defeat_message = (
-                    f"🎯 The {enemy['type']} succumbs to your {user_input.lower()}!\n"
-                    f"{enemy['template']['death_behavior']}"
-                )
-                self.threat_manager.resolve_threat()
-                self.add_message(defeat_message, is_user=False)
-                self.add_message("The dungeon grows quiet again. What will you do? 1) Continue exploring, 2) Rest, 3) Check your inventory.", is_user=False)
-                return
-
-
-        memory_facts = get_priority_memory()
-        memory_block = ""
-        if memory_facts:
-            memory_block = (
-                "The following are **absolute facts** about the player. "
-                "You MUST NOT contradict them. If the player attempts something that goes against these, correct them in a way that satisfies these facts.\n\n"
+        defeated = self.threat_manager.enemy_revealed and enemy and self.threat_manager.check_defeat(user_input)
+        if defeated:
+            self.threat_manager.resolve_threat()
+        # The snapshot is taken after the turn is applied, so navigating back here restores it as is.
+        self.record_turn(new_node)
+        self.story_store.add_node(self.store_session, new_node, self.threat_snapshots)
+        self.story_store.set_head(self.store_session, new_node)
+
+        if defeated:
+            defeat_message = (
+                f"🎯 The {enemy['type']} succumbs to your {user_input.lower()}!\n"
+                f"{enemy['template']['death_behavior']}"
             )
-            memory_block += "\n".join(f"- FACT: {fact}" for fact in memory_facts) + "\n\n"
-
-        path_block = ""
-        if self.include_full_path:
-            path_block = build_path_from_prompt(self.current_node.getPath())
-            self.include_full_path = False
-        else:
-            path_block = build_current_prompt(self.current_node.parent.state, self.current_node.choice)
+            self.speculator.release()
+            self.add_message(defeat_message, is_user=False)
+            self.add_message("The dungeon grows quiet again. What will you do? 1) Continue exploring, 2) Rest, 3) Check your inventory.", is_user=False)
+            return
 
-        enemy_block = ""
-        transition_block = ""
-        if enemy and self.threat_manager.enemy_revealed:
-            if self.threat_manager.turn_counter == self.threat_manager.last_threat:
-                transition_block = (
-                    f"You are to first transition the envrionment to the domain of the enemy before fully introducing them"
-                    f" You have to transition the current scene to a scene that fits the domain of the enemy. It should be done seamlessly, and the domain of the enemy should not be changed. It should be exactly described."
-                    )
 
-            enemy_block = (
-                f"Current Enemy: {enemy['type']}\n"
-                f"Domain: {enemy['template']['domain']}\n"
-                f"Powers: {', '.join(enemy['template']['powers'])}\n"
-                f"Weaknesses: {', '.join(enemy['template']['weaknesses'])}\n"
-                f"Hint: {enemy['template']['hint']}\n"
-                f"Threat Level: {enemy['template']['threat_level']}"
-                "You MUST select the current enemy ONLY from the following types: Fire Golem, Skeleton Warrior, Orc, Dragon. "
-                "Do NOT invent new enemies. Narrate the scene based on the player's last action, incorporating the enemy's domain, but do not resolve actions, suggest plans, or make decisions for the player. "
-                "Always end your response with three action options (e.g., 'What will you do? 1) Option A, 2) Option B, 3) Option C').\n\n"
-            )
-        death_rules_block = ""
-        if enemy:
-            threat_level = enemy["template"].get("threat_level", 0)
-            if threat_level >= 10:
-                death_rules_block = (
-                    " Player Death Rules:\n"
-                    f"- If the player does NOT flee (by using the word 'flee', 'run away', 'escape', or similar), you MUST kill them immediately."
-                    f"- Any action involving fighting, dodging, blocking, or standing their ground must result in instant death."
-                    f"- You MUST interpret all combat or hesitation as failure to flee. Do not be lenient."
-                    )
-                
-            elif 7 <= threat_level <= 9:
-                death_rules_block = (
-                    "🪦 Player Death Rules:\n"
-                    "- The enemy is a **high-level threat (7-9)**. If the player does NOT use a listed weakness, they MUST die.\n"
-                    "- You must describe the player's death vividly using language such as:\n"
-                    "  'rips through your chest', 'slams you against the wall with a deafening crack', 'you die', 'your vision fades'.\n"
-                    "- Only spare them if they cleverly use a weakness.\n"
-                )
-            
-        prompt = (
-            system_prompt + "\n\n"
-            + "Do NOT introduce any enemies in the narrative unless explicitly instructed in the 'Enemy Information' section. "
-            "Focus on the dungeon environment and the player's actions, ensuring the scene aligns with the current context.\n\n"
-            + memory_block
-            + enemy_block
-            + transition_block
-            + death_rules_block
-            + f"⚠️ Enemy Information:\n{self.threat_manager.get_enemy_description()}\n\n"
-            + path_block + "\n\n"
-            + "Describe the scene and the effects of the player's action without resolving the outcome or making decisions. "
-            "If the player's action does not use a weakness when an enemy is present, describe its failure and repeat the hint. "
-            "Do NOT introduce new enemies or conclude the encounter until the player uses a weakness to defeat the current enemy. "
-            "Always provide exactly three action options at the end of your response."
-        )
+        prompt, context, resume_prompt = self.build_turn_prompt(new_node, self.threat_manager, self.include_full_path, session=self.session_id)
+        self.include_full_path = False
+        self.report_dropped_context(self.last_context_report)
+        speculative_node = self.speculator.take(new_node.parent, new_node.choice, prompt)
 
         model_label = QLabel("")
+
         model_label.setWordWrap(True)
         model_label.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Preferred)
         model_label.setMaximumWidth(int(self.width() * 0.7))
@@ -470,21 +761,77 @@ class AIDungeonMasterChat(QMainWindow):
         self.message_widgets.append((container, False, None))
         QApplication.processEvents()
 
-        self.stop_streaming = False
-        full_text = ""
-        for chunk in query_ollama_streaming(prompt):
-            if self.stop_streaming:
-                model_label.setText(full_text + "\n[Stopped by user]")
-                stop_button.hide()
-                break
-            full_text += chunk
-            model_label.setText(full_text)
-            QApplication.processEvents()
+        if speculative_node is not None:
+            self.speculator.release()
+            model_label.setText(speculative_node.state)
+            stop_button.hide()
+            new_node.state = speculative_node.state
+            new_node.context = speculative_node.context
+            new_node.telemetry = speculative_node.telemetry
+            self.summarizer.submit(new_node)
+            self.story_index.add(new_node)
+            self.story_store.update_state(new_node)
+            self.archiver.turn_finished(self.current_node)
             QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(
                 self.scroll_area.verticalScrollBar().maximum()))
+            self.start_speculation()
+            return
 
+        self.stop_streaming = False
+        full_text = ""
+        self.summarizer.pause()
+        stream = query_ollama_streaming(prompt, client=self.ollama_client, context=context, options=self.generation_options,
+                                        resume_prompt=resume_prompt)
+        self.active_stream = stream
+        # Cancelled only after subscribing: a speculation already generating this exact request
+        # keeps its upstream stream, and this turn joins it instead of starting over.
+        self.speculator.release()
+        connection_lost = False
+        detector = ThirdChoiceDetector()
+        try:
+            for chunk in stream:
+                if detector.cutoff is None:
+                    full_text += chunk
+                    if self.enforce_choice_cutoff and detector.feed(chunk, stream.token_count) is not None:
+                        full_text = full_text[:detector.cutoff]
+                elif detector.should_close(stream.token_count):
+                    stream.close(wasted=False)
+                    break
+                model_label.setText(full_text)
+                self.tokens_per_second_label.setText(f"⚡ {stream.tokens_per_second():.1f} tok/s")
+                QApplication.processEvents()
+                QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(
+                    self.scroll_area.verticalScrollBar().maximum()))
+        except (requests.RequestException, OllamaError):
+            # The client already retried and resumed; what arrived so far is kept.
+            connection_lost = True
+
+        self.active_stream = None
+        self.summarizer.resume()
+        if detector.cutoff is not None:
+            record_choice_cutoff(stream, detector)
+        if self.stop_streaming:
+            model_label.setText(full_text + "\n[Stopped by user]")
+        elif connection_lost:
+            model_label.setText(full_text + "\n[Connection to the narrator was lost]")
         stop_button.hide()
-        self.current_node.state = full_text.strip()
+        new_node.state = full_text.strip()
+        new_node.context = stream.context
+        new_node.telemetry = stream.telemetry
+        self.summarizer.submit(new_node)
+        self.story_index.add(new_node)
+        self.story_store.update_state(new_node)
+        self.archiver.turn_finished(self.current_node)
+        if stream.telemetry is not None:
+            ttft = stream.telemetry.get("time_to_first_token", 0.0)
+            readout = f"⚡ {stream.telemetry['tokens_per_second']:.1f} tok/s · TTFT {ttft:.2f}s"
+            if not context and self.prompt_assembler.last_reuse_ratio is not None:
+                readout += f" · prefix reuse {self.prompt_assembler.last_reuse_ratio:.0%}"
+            if stream.telemetry.get("cutoff_trimmed_tokens"):
+                readout += f" · ✂️ {stream.telemetry['cutoff_trimmed_tokens']} tokens after the options dropped"
+            self.tokens_per_second_label.setText(readout)
+        if not self.stop_streaming and not connection_lost:
+            self.start_speculation()
     # def player_fled(self, user_input: str) -> bool:
     #     flee_words = ["flee", "run", "escape", "retreat", "sprint", "get away"]
     #     return any(word in user_input.lower() for word in flee_words)
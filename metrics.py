@@ -0,0 +1,72 @@
+import bisect
+import threading
+
+counters = {}
+histograms = {}
+gauges = {}
+lock = threading.Lock()
+
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 200)
+SESSION_BYTES_BUCKETS = (2 ** 20, 4 * 2 ** 20, 16 * 2 ** 20, 64 * 2 ** 20, 256 * 2 ** 20, 2 ** 30)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        labels = [f"<={bucket}" for bucket in self.buckets] + [f">{self.buckets[-1]}"]
+        return {"count": self.count, "mean": self.mean(), "buckets": dict(zip(labels, self.counts))}
+
+
+def increment(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def get_counter(name):
+    return counters.get(name, 0)
+
+
+def set_gauge(name, value):
+    with lock:
+        gauges[name] = value
+
+
+def get_gauge(name):
+    return gauges.get(name, 0)
+
+
+def observe(name, value, buckets):
+    with lock:
+        if name not in histograms:
+            histograms[name] = Histogram(buckets)
+        histograms[name].observe(value)
+
+
+def get_metrics():
+    with lock:
+        result = dict(counters)
+        result.update(gauges)
+        for name, histogram in histograms.items():
+            result[name] = histogram.snapshot()
+        return result
+
+
+def clear_metrics():
+    with lock:
+        counters.clear()
+        histograms.clear()
+        gauges.clear()
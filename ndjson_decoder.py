@@ -0,0 +1,69 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class NDJSONDecoder:
+    """Splits raw byte chunks into complete NDJSON lines and decodes them."""
+
+    def __init__(self):
+        self.pending = b""
+
+    def feed(self, data):
+        if self.pending:
+            data = self.pending + data
+        end = data.rfind(b"\n")
+        if end < 0:
+            self.pending = data
+            return []
+        self.pending = data[end + 1:]
+        if end == len(data) - 1 and end > 0 and data.find(b"\n", 0, end) < 0:
+            # A single complete line, the usual read while the reader keeps up.
+            return [loads(data)]
+        # orjson parses memoryview slices in place; json.loads needs bytes.
+        view = memoryview(data) if orjson is not None else data
+        objects = []
+        start = 0
+        while start < end:
+            stop = data.find(b"\n", start, end + 1)
+            if stop > start:
+                objects.append(loads(view[start:stop]))
+            start = stop + 1
+        return objects
+
+    def flush(self):
+        pending, self.pending = self.pending, b""
+        return [loads(pending)] if pending.strip() else []
+
+
+def merge(run):
+    if len(run) == 1:
+        return run[0]
+    # A copy, since the chunks may be shared with other readers.
+    return dict(run[0], response="".join([chunk["response"] for chunk in run]),
+                chunk_count=sum([chunk.get("chunk_count", 1) for chunk in run]))
+
+
+def coalesce(objects):
+    # Tokens that arrived in the same read are merged into a single chunk; "chunk_count"
+    # keeps the number of tokens it stands for, including those of already merged chunks.
+    run = []
+    for chunk in objects:
+        if chunk.get("done"):
+            if run:
+                yield merge(run)
+                run = []
+            yield chunk
+        else:
+            run.append(chunk)
+    if run:
+        yield merge(run)
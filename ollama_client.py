@@ -0,0 +1,672 @@
+import asyncio
+import itertools
+import json
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+import metrics
+from ndjson_decoder import NDJSONDecoder, coalesce, loads
+from response_cache import request_key, is_deterministic
+
+DEFAULT_BASE_URL = "http://localhost:11434"
+
+# Raw-mode requests skip Ollama's prompt template, so resumed generations apply it themselves.
+# Keyed by model name without its tag; streams from other models are not resumed.
+RAW_TEMPLATES = {
+    "mistral": "[INST] {prompt} [/INST]",
+    "llama3": "<|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|>"
+              "<|start_header_id|>assistant<|end_header_id|>\n\n",
+}
+
+# Timing and token counts Ollama reports in the final chunk of a generation (durations in ns).
+TELEMETRY_FIELDS = ("total_duration", "load_duration", "prompt_eval_count",
+                    "prompt_eval_duration", "eval_count", "eval_duration")
+
+
+def iter_batches(response):
+    decoder = NDJSONDecoder()
+    for data in response.iter_content(chunk_size=None):
+        objects = decoder.feed(data)
+        if objects:
+            yield objects
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+
+def build_generate_payload(prompt, model, stream, context=None, options=None, keep_alive=None):
+    payload = {
+        "prompt": prompt,
+        "model": model,
+        "stream": stream
+    }
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    if context:
+        payload["context"] = context
+    if options:
+        payload["options"] = options
+    return payload
+
+
+class OllamaError(Exception):
+    pass
+
+
+def shutdown_socket(sock):
+    # Unlike close(), shutdown() wakes a thread blocked reading the socket and tells the server
+    # at once, which makes Ollama stop generating.
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class ConnectionAbort:
+    """Lets another thread drop a request's connection, even before its response has started."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sock = None
+        self.aborted = False
+
+    def attach(self, sock):
+        with self.lock:
+            self.sock = sock
+            if self.aborted:
+                shutdown_socket(sock)
+
+    def detach(self, sock):
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            if self.sock is not None:
+                shutdown_socket(self.sock)
+
+
+# The ConnectionAbort of the request the current thread is sending, if any.
+pending_aborts = threading.local()
+
+
+def attach_pending_abort(connection):
+    abort = getattr(pending_aborts, "abort", None)
+    if abort is not None and connection.sock is not None:
+        connection.abort = abort
+        abort.attach(connection.sock)
+
+
+def detach_abort(connection):
+    # A connection going back to the pool must not be dropped by the request that used it last.
+    if connection is not None and connection.abort is not None:
+        connection.abort.detach(connection.sock)
+        connection.abort = None
+
+
+class AbortableHTTPConnection(HTTPConnection):
+    abort = None
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        attach_pending_abort(self)
+
+
+class AbortableHTTPSConnection(HTTPSConnection):
+    abort = None
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        attach_pending_abort(self)
+
+
+class AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = AbortableHTTPConnection
+
+    def _put_conn(self, conn):
+        detach_abort(conn)
+        super()._put_conn(conn)
+
+
+class AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = AbortableHTTPSConnection
+
+    def _put_conn(self, conn):
+        detach_abort(conn)
+        super()._put_conn(conn)
+
+
+class AbortableAdapter(HTTPAdapter):
+    # Ollama sends no headers until the first token, so the socket has to be reachable while
+    # requests is still waiting for the response.
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": AbortableHTTPConnectionPool,
+                                                   "https": AbortableHTTPSConnectionPool}
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+
+
+class BackendPool:
+    def __init__(self, urls, max_failures=2):
+        self.backends = [Backend(url) for url in urls]
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        with self.lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            # When every backend has been ejected, still try them rather than fail outright.
+            healthy = [b for b in candidates if b.healthy] or candidates
+            if not healthy:
+                return None
+            backend = min(healthy, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend):
+        with self.lock:
+            backend.outstanding -= 1
+
+    def mark_failed(self, backend):
+        with self.lock:
+            backend.failures += 1
+            if backend.failures >= self.max_failures:
+                backend.healthy = False
+
+    def mark_ok(self, backend):
+        with self.lock:
+            backend.failures = 0
+            backend.healthy = True
+
+
+class OllamaClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, pool_connections=1, pool_maxsize=4,
+                 connect_timeout=3.05, read_timeout=120, max_retries=2, backoff_factor=0.5, cache=None,
+                 keep_alive="30m", base_urls=None, max_failures=2, health_check_interval=10.0,
+                 max_resume_attempts=3, resume_backoff=0.5, raw_templates=RAW_TEMPLATES):
+        self.backends = BackendPool(base_urls or [base_url], max_failures)
+        self.max_resume_attempts = max_resume_attempts
+        self.resume_backoff = resume_backoff
+        self.raw_templates = raw_templates
+        self.cache = cache
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        self.health_check_interval = health_check_interval
+        self.health_thread = None
+        self.closed = threading.Event()
+        self.session = requests.Session()
+        # Only connection errors are retried: once Ollama accepted a POST it is already generating.
+        retry = Retry(total=max_retries, connect=max_retries, read=0, status=0,
+                      backoff_factor=backoff_factor, allowed_methods=None)
+        # pool_block caps the number of open connections per host at pool_maxsize.
+        adapter = AbortableAdapter(pool_connections=max(pool_connections, len(self.backends.backends)),
+                              pool_maxsize=pool_maxsize, max_retries=retry, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def open(self, path, payload, stream, abort=None):
+        # Routes to the least busy backend and fails over until a backend produces its first line.
+        # Returns the first batch of decoded objects and an iterator over the following batches.
+        # abort, a ConnectionAbort, can drop the request from another thread.
+        tried = []
+        last_error = None
+        while True:
+            backend = self.backends.acquire(exclude=tried)
+            if backend is None:
+                raise OllamaError(f"No Ollama backend could serve the request: {last_error}")
+            tried.append(backend)
+            response = None
+            pending_aborts.abort = abort
+            try:
+                response = self.session.post(backend.url + path, json=payload, stream=stream, timeout=self.timeout)
+                if response.status_code >= 500:
+                    response.close()
+                    raise requests.HTTPError(f"{backend.url} returned HTTP {response.status_code}", response=response)
+                response.raise_for_status()
+                batches = iter_batches(response) if stream else iter([[loads(response.content)]])
+                first = next(batches, [])
+            except requests.RequestException as error:
+                if response is not None:
+                    response.close()
+                self.backends.release(backend)
+                if abort is not None and abort.aborted:
+                    raise
+                if error.response is None or error.response.status_code >= 500:
+                    self.backends.mark_failed(backend)
+                last_error = error
+                continue
+            finally:
+                pending_aborts.abort = None
+            self.backends.mark_ok(backend)
+            return backend, response, first, batches
+
+    def generate(self, prompt, model="mistral", context=None, options=None):
+        payload = build_generate_payload(prompt, model, False, context, options, self.keep_alive)
+        backend, response, first, _ = self.open("/api/generate", payload, stream=False)
+        self.backends.release(backend)
+        return first[0]
+
+    def generate_streaming(self, prompt, model="mistral", context=None, options=None, abort=None, resume_prompt=None):
+        batches = self.generate_batches(prompt, model, context, options, abort, resume_prompt)
+        try:
+            for batch in batches:
+                yield from batch
+        finally:
+            # Closes the response at once rather than when the generator is collected.
+            batches.close()
+
+    def generate_batches(self, prompt, model="mistral", context=None, options=None, abort=None, resume_prompt=None):
+        # Like generate_streaming, but yields a list of chunks per socket read, so a consumer
+        # that hands chunks to another thread can do so once per read instead of once per token.
+        payload = build_generate_payload(prompt, model, True, context, options, self.keep_alive)
+        key = None
+        if self.cache is not None and is_deterministic(payload):
+            key = request_key(payload)
+            record = self.cache.get(key)
+            if record is not None:
+                metrics.increment("response_cache_hits")
+                for chunk in self.cache.replay(record):
+                    yield [chunk]
+                return
+            metrics.increment("response_cache_misses")
+        # Raw mode ignores "context", so a request that relies on one is continued from
+        # resume_prompt, the same turn written out in full, and cannot be continued without it.
+        raw_prompt = resume_prompt if context else prompt
+        raw_template = self.raw_templates.get(model.split(":")[0]) if raw_prompt is not None else None
+        start = time.monotonic()
+        recorded = []
+        partial = []
+        attempt = 0
+        request = payload
+        while True:
+            backend, response, first, batches = self.open("/api/generate", request, True, abort)
+            try:
+                with response:
+                    for objects in itertools.chain([first], batches):
+                        batch = objects if len(objects) == 1 else list(coalesce(objects))
+                        for chunk in batch:
+                            partial.append(chunk["response"])
+                            if key is not None:
+                                recorded.append([time.monotonic() - start, chunk])
+                        if batch:
+                            yield batch
+                break
+            except requests.RequestException:
+                # The connection dropped mid-stream: continue from the text received so far
+                # with a raw-mode request instead of regenerating the whole narration.
+                if attempt >= self.max_resume_attempts or raw_template is None or (abort is not None and abort.aborted):
+                    raise
+                self.backends.mark_failed(backend)
+                metrics.increment("resumed_streams")
+                time.sleep(self.resume_backoff * 2 ** attempt)
+                attempt += 1
+                request = dict(payload, raw=True, prompt=raw_template.format(prompt=raw_prompt) + "".join(partial))
+                request.pop("context", None)
+            finally:
+                self.backends.release(backend)
+        # Only complete generations are cached; a cancelled stream never gets here.
+        if key is not None and recorded and recorded[-1][1].get("done"):
+            self.cache.put(key, recorded)
+
+    def warm_up(self, model="mistral", options=None):
+        # An empty prompt makes Ollama load the model (and keep it for keep_alive) without
+        # generating. Every backend is warmed, since any of them may get the next turn. Pass the
+        # num_ctx the narrations use, or the first of them reloads the model.
+        payload = build_generate_payload("", model, False, options=options, keep_alive=self.keep_alive)
+        results = []
+        for backend in self.backends.backends:
+            try:
+                response = self.session.post(backend.url + "/api/generate", json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                results.append(response.json())
+            except requests.RequestException:
+                self.backends.mark_failed(backend)
+        if not results:
+            raise OllamaError("No Ollama backend could load the model")
+        return results
+
+    def check_health(self):
+        for backend in self.backends.backends:
+            try:
+                self.session.get(backend.url + "/api/version", timeout=self.connect_timeout).raise_for_status()
+            except requests.RequestException:
+                self.backends.mark_failed(backend)
+            else:
+                self.backends.mark_ok(backend)
+
+    def start_health_checks(self):
+        def run():
+            while not self.closed.wait(self.health_check_interval):
+                self.check_health()
+
+        if self.health_thread is None:
+            self.health_thread = threading.Thread(target=run, daemon=True)
+            self.health_thread.start()
+
+    def close(self):
+        self.closed.set()
+        self.session.close()
+
+
+default_client = OllamaClient()
+
+
+class OllamaStream:
+    """Iterates the text of a streamed generation and keeps the final chunk's metadata."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.final = None
+        self.context = None
+        self.token_count = 0
+        self.cancelled = False
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.telemetry = None
+
+    def handle_chunk(self, chunk):
+        if chunk.get("done"):
+            self.final = chunk
+            self.context = chunk.get("context")
+            self.record_telemetry()
+        else:
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self.token_count += chunk.get("chunk_count", 1)
+        return chunk["response"]
+
+    def tokens_per_second(self):
+        # Client-side rate while streaming; Ollama's own eval rate once the final chunk is in.
+        if self.telemetry is not None:
+            return self.telemetry["tokens_per_second"]
+        if self.first_token_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self.first_token_at
+        return self.token_count / elapsed if elapsed > 0 else 0.0
+
+    def record_telemetry(self):
+        telemetry = {field: self.final.get(field) for field in TELEMETRY_FIELDS}
+        if self.first_token_at is not None:
+            telemetry["time_to_first_token"] = self.first_token_at - self.started_at
+        eval_count = self.final.get("eval_count") or 0
+        eval_duration = self.final.get("eval_duration") or 0
+        telemetry["tokens_per_second"] = eval_count / (eval_duration / 1e9) if eval_duration else 0.0
+        self.telemetry = telemetry
+        if "time_to_first_token" in telemetry:
+            metrics.observe("time_to_first_token_seconds", telemetry["time_to_first_token"], metrics.TTFT_BUCKETS)
+        if eval_duration:
+            metrics.observe("tokens_per_second", telemetry["tokens_per_second"], metrics.TOKENS_PER_SECOND_BUCKETS)
+        metrics.increment("prompt_eval_tokens", self.final.get("prompt_eval_count") or 0)
+        metrics.increment("eval_tokens", eval_count)
+
+    def record_client_telemetry(self):
+        # For a stream closed before its final chunk: only what the client measured itself.
+        telemetry = {"tokens_per_second": self.tokens_per_second()}
+        metrics.observe("tokens_per_second", telemetry["tokens_per_second"], metrics.TOKENS_PER_SECOND_BUCKETS)
+        if self.first_token_at is not None:
+            telemetry["time_to_first_token"] = self.first_token_at - self.started_at
+            metrics.observe("time_to_first_token_seconds", telemetry["time_to_first_token"], metrics.TTFT_BUCKETS)
+        self.telemetry = telemetry
+
+    def record_cancel(self, wasted):
+        if self.final is None and not self.cancelled:
+            self.cancelled = True
+            if wasted:
+                # Only a generation whose text is thrown away, such as a speculation the player
+                # did not take, counts as wasted.
+                metrics.increment("cancelled_generations")
+                metrics.increment("wasted_tokens", self.token_count)
+
+    def stop(self):
+        # The player pressed Stop: the text received so far is kept as the narration, so it is
+        # counted on its own rather than as wasted tokens.
+        if self.final is None and not self.cancelled:
+            metrics.increment("stopped_generations")
+            metrics.increment("stopped_tokens", self.token_count)
+        self.close(wasted=False)
+
+    def close(self, wasted=True):
+        # Closing the generator closes the HTTP response: the socket is dropped, which aborts
+        # generation on the Ollama side, and the pool slot is released. Pass wasted=False when
+        # the text received so far is kept.
+        self.record_cancel(wasted)
+        self.chunks.close()
+
+    async def aclose(self, wasted=True):
+        self.record_cancel(wasted)
+        await self.chunks.aclose()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield self.handle_chunk(chunk)
+
+    async def __aiter__(self):
+        async for chunk in self.chunks:
+            yield self.handle_chunk(chunk)
+
+
+class AsyncOllamaClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, max_connections=256,
+                 connect_timeout=3.05, read_timeout=120, keep_alive="30m", base_urls=None, max_failures=2,
+                 ssl_context=None):
+        self.backends = BackendPool(base_urls or [base_url], max_failures)
+        for backend in self.backends.backends:
+            if urlsplit(backend.url).scheme not in ("http", "https"):
+                raise ValueError(f"Unsupported Ollama URL: {backend.url}")
+        # Used for https:// backends; the system's default trust store when not given.
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.keep_alive = keep_alive
+        self._semaphore = None
+        self._idle = {}
+
+    async def _connect(self, backend, reuse=True):
+        # Returns the reader, the writer and whether the connection came from the idle pool.
+        idle = self._idle.setdefault(backend.url, [])
+        while reuse and idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        parts = urlsplit(backend.url)
+        if parts.scheme == "https":
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            connection = asyncio.open_connection(parts.hostname, parts.port or 443, ssl=self.ssl_context)
+        else:
+            connection = asyncio.open_connection(parts.hostname, parts.port or 80)
+        reader, writer = await asyncio.wait_for(connection, self.connect_timeout)
+        return reader, writer, False
+
+    async def _read(self, writer, awaitable):
+        # asyncio.wait_for can swallow a cancellation that races a finished read, so the
+        # read timeout aborts the transport instead.
+        timer = asyncio.get_running_loop().call_later(self.read_timeout, writer.transport.abort)
+        try:
+            return await awaitable
+        finally:
+            timer.cancel()
+
+    async def _send(self, reader, writer, backend, path, payload):
+        body = json.dumps(payload).encode("utf-8")
+        head = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {urlsplit(backend.url).netloc}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+        status_line = await self._read(writer, reader.readline())
+        if not status_line:
+            raise ConnectionResetError("Connection closed before a response was received")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self._read(writer, reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _open(self, backend, path, payload):
+        # An idle connection the server has since closed fails before any status line arrives.
+        # The request never reached Ollama, so it is sent once more on a new connection.
+        reader, writer, reused = await self._connect(backend)
+        try:
+            return reader, writer, await self._send(reader, writer, backend, path, payload)
+        except (OSError, asyncio.IncompleteReadError):
+            writer.close()
+            if not reused:
+                raise
+        metrics.increment("stale_connections")
+        reader, writer, _ = await self._connect(backend, reuse=False)
+        try:
+            return reader, writer, await self._send(reader, writer, backend, path, payload)
+        except BaseException:
+            writer.close()
+            raise
+
+    async def _iter_body(self, reader, writer, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            # Reads whatever the socket has buffered and strips the chunk framing in bulk, so a
+            # consumer that falls behind gets many tokens per read instead of one.
+            pending = bytearray()
+            remaining = 0
+            while True:
+                data = await self._read(writer, reader.read(65536))
+                if not data:
+                    raise asyncio.IncompleteReadError(bytes(pending), None)
+                pending += data
+                body = bytearray()
+                while True:
+                    if remaining > 0:
+                        take = min(remaining, len(pending))
+                        body += pending[:take]
+                        del pending[:take]
+                        remaining -= take
+                        if remaining:
+                            break
+                        remaining = -2
+                    if remaining == -2:
+                        if len(pending) < 2:
+                            break
+                        del pending[:2]
+                        remaining = 0
+                    eol = pending.find(b"\r\n")
+                    if eol < 0:
+                        break
+                    size = int(bytes(pending[:eol]).split(b";")[0], 16)
+                    if size == 0:
+                        # The last chunk is followed by an (empty) trailer section.
+                        while not pending.endswith(b"\r\n\r\n"):
+                            data = await self._read(writer, reader.read(65536))
+                            if not data:
+                                raise asyncio.IncompleteReadError(bytes(pending), None)
+                            pending += data
+                        if body:
+                            yield bytes(body)
+                        return
+                    del pending[:eol + 2]
+                    remaining = size
+                if body:
+                    yield bytes(body)
+        elif "content-length" in headers:
+            yield await self._read(writer, reader.readexactly(int(headers["content-length"])))
+        else:
+            while True:
+                data = await self._read(writer, reader.read(65536))
+                if not data:
+                    return
+                yield data
+
+    async def _stream_lines(self, path, payload):
+        # The semaphore is created lazily so that it binds to the running event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        async with self._semaphore:
+            tried = []
+            last_error = None
+            while True:
+                backend = self.backends.acquire(exclude=tried)
+                if backend is None:
+                    raise OllamaError(f"No Ollama backend could serve the request: {last_error}")
+                tried.append(backend)
+                writer = None
+                reusable = False
+                started = False
+                try:
+                    reader, writer, (status, headers) = await self._open(backend, path, payload)
+                    if status >= 400:
+                        body = b"".join([data async for data in self._iter_body(reader, writer, headers)])
+                        last_error = OllamaError(f"Ollama returned HTTP {status}: {body.decode('utf-8', 'replace')}")
+                        if status < 500:
+                            raise last_error
+                        self.backends.mark_failed(backend)
+                        continue
+                    decoder = NDJSONDecoder()
+                    async for data in self._iter_body(reader, writer, headers):
+                        for chunk in coalesce(decoder.feed(data)):
+                            started = True
+                            yield chunk
+                    for chunk in decoder.flush():
+                        yield chunk
+                    reusable = headers.get("connection", "").lower() != "close"
+                    self.backends.mark_ok(backend)
+                    return
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as error:
+                    # Fail over only while nothing has been yielded to the consumer.
+                    if started:
+                        raise
+                    self.backends.mark_failed(backend)
+                    last_error = error
+                finally:
+                    self.backends.release(backend)
+                    # A cancelled or failed request leaves unread data on the socket, so it is
+                    # closed instead of pooled; closing it also makes Ollama stop generating.
+                    if reusable:
+                        self._idle[backend.url].append((reader, writer))
+                    elif writer is not None:
+                        writer.close()
+
+    async def generate(self, prompt, model="mistral", context=None, options=None):
+        payload = build_generate_payload(prompt, model, False, context, options, self.keep_alive)
+        chunks = [chunk async for chunk in self._stream_lines("/api/generate", payload)]
+        return chunks[-1] if chunks else None
+
+    async def generate_streaming(self, prompt, model="mistral", context=None, options=None):
+        payload = build_generate_payload(prompt, model, True, context, options, self.keep_alive)
+        async for chunk in self._stream_lines("/api/generate", payload):
+            yield chunk
+
+    async def close(self):
+        for idle in self._idle.values():
+            while idle:
+                _, writer = idle.pop()
+                writer.close()
+
+
+default_async_client = AsyncOllamaClient()
@@ -0,0 +1,75 @@
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex
+from PyQt6.QtWidgets import QListView, QAbstractItemView
+
+
+def render_path_entry(node, is_first):
+    if is_first:
+        return f"🌟 Start: {node.state.strip()}"
+    return f"🧭 Player chose: {node.choice.strip()}\n📖 Resulting situation:\n{node.state.strip()}"
+
+
+class PathModel(QAbstractListModel):
+    """Story path entries, exposed a page at a time and rendered only when the view asks for them."""
+
+    def __init__(self, head, page_size=20, parent=None):
+        super().__init__(parent)
+        self.head = head
+        self.page_size = page_size
+        self.nodes = []
+        self.load_page()
+
+    def load_page(self):
+        # The last node of the page is reached through jump pointers and the rest by walking up
+        # from it, so a long story is only read from the store as far as the view scrolls.
+        count = min(self.page_size, self.head.depth + 1 - len(self.nodes))
+        node = self.head.ancestor_at_depth(len(self.nodes) + count - 1)
+        page = [None] * count
+        for index in range(count - 1, -1, -1):
+            page[index] = node
+            if index:
+                node = node.parent
+        self.nodes.extend(page)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.nodes)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        row = index.row()
+        return render_path_entry(self.nodes[row], row == 0)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and len(self.nodes) <= self.head.depth
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        loaded = len(self.nodes)
+        count = min(self.page_size, self.head.depth + 1 - loaded)
+        self.beginInsertRows(QModelIndex(), loaded, loaded + count - 1)
+        self.load_page()
+        self.endInsertRows()
+
+
+class PathView(QListView):
+    def __init__(self, head, page_size=20, parent=None):
+        super().__init__(parent)
+        self.setModel(PathModel(head, page_size, self))
+        self.setWordWrap(True)
+        self.setSpacing(6)
+        # Loaded pages are laid out in batches so the event loop keeps running in between.
+        self.setLayoutMode(QListView.LayoutMode.Batched)
+        self.setBatchSize(page_size)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.setMinimumHeight(360)
+        self.setStyleSheet("""
+            QListView {
+                padding: 12px;
+                border-radius: 10px;
+                background-color: #FFFFFF;
+                color: #000000;
+                font-size: 14px;
+            }
+        """)
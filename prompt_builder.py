@@ -0,0 +1,159 @@
+import re
+
+import metrics
+from story_tree import PATH_PROMPT_HEADER, PATH_PROMPT_FOOTER, build_path_from_nodes, build_summary_segment
+
+# Sections from most to least stable across turns. Keeping the stable text in front lets the
+# backend reuse its cached prefix for everything up to the first section that changed.
+SECTION_ORDER = (
+    "system",
+    "rules",
+    "closing",
+    "memory",
+    "death_rules",
+    "enemy",
+    "enemy_description",
+    "transition",
+    "recall",
+    "path",
+)
+
+PREFIX_REUSE_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0)
+
+
+def common_prefix_length(a, b):
+    # Binary search over slice comparisons keeps the character loop in C.
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class PromptAssembler:
+    def __init__(self):
+        self.previous_prompts = {}
+        self.last_reuse_ratio = None
+
+    def assemble(self, sections, session=None):
+        prompt = "".join(sections.get(name, "") for name in SECTION_ORDER)
+        if session is not None:
+            self.record_prefix_reuse(session, prompt)
+        return prompt
+
+    def record_prefix_reuse(self, session, prompt):
+        previous = self.previous_prompts.get(session)
+        self.previous_prompts[session] = prompt
+        if previous is None or not prompt:
+            return
+        shared = common_prefix_length(previous, prompt)
+        self.last_reuse_ratio = shared / len(prompt)
+        metrics.observe("prefix_reuse_ratio", self.last_reuse_ratio, PREFIX_REUSE_BUCKETS)
+        metrics.increment("prefix_reused_chars", shared)
+        metrics.increment("prompt_chars", len(prompt))
+
+    def forget(self, session):
+        self.previous_prompts.pop(session, None)
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text):
+    # Rough BPE estimate: about four characters per token for words, one per punctuation mark.
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PATTERN.findall(text))
+
+
+MEMORY_HEADER = (
+    "The following are **absolute facts** about the player. "
+    "You MUST NOT contradict them. If the player attempts something that goes against these, correct them in a way that satisfies these facts.\n\n"
+)
+
+
+def build_memory_block(facts):
+    if not facts:
+        return ""
+    return MEMORY_HEADER + "\n".join(f"- FACT: {fact}" for fact in facts) + "\n\n"
+
+
+RECALL_HEADER = "Earlier scenes that may matter for the player's action:\n"
+
+
+def build_recall_block(nodes):
+    if not nodes:
+        return ""
+    return "".join([RECALL_HEADER, *[node.path_segment() for node in nodes], "\n"])
+
+
+class ContextBuilder:
+    """Fills a token budget by priority: fixed sections, memory facts, the enemy, then the newest turns."""
+
+    def __init__(self, token_budget=3328):
+        self.token_budget = token_budget
+
+    def build(self, fixed_sections, memory_facts, enemy_sections, path=None, current_block="", summary=None, recalled=(),
+              reserved=0):
+        # memory_facts are ordered from highest priority down. path holds tree nodes oldest first
+        # and is only given for full-path prompts, optionally preceded by a summary of everything
+        # before it; otherwise current_block (the latest exchange) is always kept. recalled holds
+        # earlier scenes ranked by relevance and only fills whatever budget is left. reserved
+        # tokens, such as a reused context, are taken off the budget first.
+        budget = self.token_budget - reserved
+        sections = dict(fixed_sections)
+        used = sum(count_tokens(text) for text in fixed_sections.values()) + count_tokens(current_block)
+        report = {"budget": budget, "dropped_facts": [], "dropped_enemy": [], "dropped_turns": [], "dropped_summary": False, "dropped_recall": []}
+
+        kept_facts = []
+        for index, fact in enumerate(memory_facts):
+            cost = count_tokens(f"- FACT: {fact}\n") + (count_tokens(MEMORY_HEADER) if not kept_facts else 0)
+            if used + cost > budget:
+                # Lower priority facts never displace a higher priority one that did not fit.
+                report["dropped_facts"] = list(memory_facts[index:])
+                break
+            kept_facts.append(fact)
+            used += cost
+        sections["memory"] = build_memory_block(kept_facts)
+
+        enemy_cost = sum(count_tokens(text) for text in enemy_sections.values())
+        if used + enemy_cost <= budget:
+            sections.update(enemy_sections)
+            used += enemy_cost
+        else:
+            report["dropped_enemy"] = [name for name, text in enemy_sections.items() if text]
+
+        if path is None:
+            sections["path"] = current_block
+        else:
+            used += count_tokens(PATH_PROMPT_HEADER) + count_tokens(PATH_PROMPT_FOOTER)
+            first_kept = len(path)
+            while first_kept > 0:
+                cost = count_tokens(path[first_kept - 1].path_segment())
+                if used + cost > budget and first_kept < len(path):
+                    break
+                used += cost
+                first_kept -= 1
+            report["dropped_turns"] = [node.choice for node in path[:first_kept]]
+            if summary is not None:
+                cost = count_tokens(build_summary_segment(summary))
+                if first_kept == 0 and used + cost <= budget:
+                    used += cost
+                else:
+                    report["dropped_summary"] = True
+                    summary = None
+            sections["path"] = build_path_from_nodes(path[first_kept:], summary)
+
+        kept_recall = []
+        for index, node in enumerate(recalled):
+            cost = count_tokens(node.path_segment()) + (count_tokens(RECALL_HEADER) if not kept_recall else 0)
+            if used + cost > budget:
+                report["dropped_recall"] = [node.choice for node in recalled[index:]]
+                break
+            kept_recall.append(node)
+            used += cost
+        sections["recall"] = build_recall_block(kept_recall)
+
+        report["used"] = used
+        return sections, report
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def request_key(payload):
+    # "stream" and "keep_alive" only change the transport and model residency, not the text.
+    keyed = {k: v for k, v in payload.items() if k not in ("stream", "keep_alive")}
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def is_deterministic(payload):
+    options = payload.get("options") or {}
+    return options.get("temperature") == 0 or options.get("seed") is not None
+
+
+class ResponseCache:
+    def __init__(self, directory="narration_cache", max_bytes=64 * 1024 * 1024, max_entries=2000, paced=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.paced = paced
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as file:
+                record = json.load(file)
+            # The file mtime carries the LRU order across restarts.
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            self.discard(key)
+            return None
+        return record
+
+    def put(self, key, chunks):
+        data = json.dumps({"chunks": chunks}, ensure_ascii=False).encode("utf-8")
+        tmp_path = self.path(key) + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path(key))
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.evict()
+
+    def discard(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.entries and (self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def replay(self, record):
+        start = time.monotonic()
+        for offset, chunk in record["chunks"]:
+            if self.paced:
+                delay = offset - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield chunk
+
+    def clear(self):
+        with self.lock:
+            keys = list(self.entries)
+        for key in keys:
+            self.discard(key)
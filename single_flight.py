@@ -0,0 +1,144 @@
+import threading
+
+import metrics
+from ndjson_decoder import merge
+from ollama_client import build_generate_payload, ConnectionAbort
+from response_cache import request_key
+
+
+class Flight:
+    """One upstream generation whose chunks are buffered and fanned out to every subscriber."""
+
+    def __init__(self, key, upstream, on_finish, abort=None):
+        self.key = key
+        self.upstream = upstream
+        self.abort = abort
+        self.on_finish = on_finish
+        self.chunks = []
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.waiting = 0
+        self.subscribers = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.thread = threading.Thread(target=self.pump, daemon=True)
+
+    def pump(self):
+        # The upstream yields a list of chunks per socket read; the lock is taken and the
+        # subscribers woken once per read, not once per token.
+        try:
+            for batch in self.upstream:
+                with self.lock:
+                    if self.cancelled:
+                        break
+                    self.chunks.extend(batch)
+                    if self.waiting:
+                        self.condition.notify_all()
+        except Exception as error:
+            self.error = error
+        finally:
+            # Closing from the pumping thread drops the upstream connection, which also stops
+            # generation on the backend when every subscriber has left.
+            self.upstream.close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            self.on_finish(self)
+
+    def subscribe(self):
+        # A flight whose last subscriber has left is already shutting down and takes no one new.
+        with self.condition:
+            if self.cancelled:
+                return None
+            self.subscribers += 1
+        return Subscription(self)
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+            if self.subscribers > 0 or self.done:
+                return
+            self.cancelled = True
+        # The pump may be blocked waiting for the backend, so the connection is dropped from
+        # here rather than when the next chunk arrives.
+        if self.abort is not None:
+            self.abort.abort()
+        self.on_finish(self)
+
+
+class Subscription:
+    def __init__(self, flight):
+        self.flight = flight
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self.flight
+        if self.closed:
+            raise StopIteration
+        with flight.condition:
+            while self.index >= len(flight.chunks) and not flight.done:
+                flight.waiting += 1
+                flight.condition.wait()
+                flight.waiting -= 1
+            chunks = flight.chunks
+            if self.index < len(chunks):
+                # Tokens the pump buffered while this subscriber was busy are handed over as one
+                # chunk; the final chunk always comes on its own.
+                start = self.index
+                end = len(chunks)
+                if chunks[start].get("done"):
+                    end = start + 1
+                elif chunks[end - 1].get("done"):
+                    end -= 1
+                self.index = end
+                return chunks[start] if end - start == 1 else merge(chunks[start:end])
+            error = flight.error
+        self.close()
+        if error is not None:
+            raise error
+        raise StopIteration
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flight.unsubscribe()
+
+
+class CoalescingClient:
+    """Attaches identical concurrent streaming requests to a single upstream generation."""
+
+    def __init__(self, client):
+        self.client = client
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def finish(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+    def generate_streaming(self, prompt, model="mistral", context=None, options=None, resume_prompt=None):
+        key = request_key(build_generate_payload(prompt, model, True, context, options))
+        with self.lock:
+            flight = self.flights.get(key)
+            # Late joiners replay the buffered chunks before receiving new ones.
+            subscription = flight.subscribe() if flight is not None else None
+            if subscription is None:
+                abort = ConnectionAbort()
+                upstream = self.client.generate_batches(prompt, model=model, context=context, options=options,
+                                                        abort=abort, resume_prompt=resume_prompt)
+                flight = Flight(key, upstream, self.finish, abort)
+                self.flights[key] = flight
+                flight.thread.start()
+                subscription = flight.subscribe()
+            else:
+                metrics.increment("coalesced_requests")
+            return subscription
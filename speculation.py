@@ -0,0 +1,93 @@
+import threading
+
+import requests
+
+import metrics
+from ollama_client import OllamaError
+from story_tree import TreeNode, query_ollama_streaming, ThirdChoiceDetector, record_choice_cutoff
+
+
+class SpeculativeGenerator:
+    def __init__(self, client, token_budget=1500):
+        self.client = client
+        self.token_budget = token_budget
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.parent_node = None
+
+    def start(self, parent_node, jobs, options=None):
+        if parent_node is not self.parent_node:
+            self.release()
+            parent_node.speculative_children = {}
+            self.parent_node = parent_node
+        self.cancel()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(parent_node, parent_node.speculative_children, jobs, options, self.cancel_event), daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        # The worker notices the event between tokens and closes its own stream.
+        self.cancel_event.set()
+
+    def release(self):
+        # Once the player has committed to a choice or moved elsewhere, the other narrations,
+        # prompts and contexts are dropped. A worker still running fills a dict nobody holds.
+        self.cancel()
+        if self.parent_node is not None:
+            self.parent_node.speculative_children = None
+            self.parent_node = None
+
+    def run(self, parent_node, results, jobs, options, cancel_event):
+        spent = 0
+        for choice, prompt, context, resume_prompt in jobs:
+            if cancel_event.is_set() or spent >= self.token_budget:
+                return
+            cached = results.get(choice)
+            if cached is not None and cached[0] == prompt:
+                continue
+            stream = query_ollama_streaming(prompt, client=self.client, context=context, options=options,
+                                            resume_prompt=resume_prompt)
+            text = ""
+            detector = ThirdChoiceDetector()
+            try:
+                for chunk in stream:
+                    if detector.cutoff is None:
+                        text += chunk
+                        if detector.feed(chunk, stream.token_count) is not None:
+                            text = text[:detector.cutoff]
+                    # Once the options are complete the narration is kept, whatever ends the stream.
+                    if detector.cutoff is not None:
+                        if detector.should_close(stream.token_count) or cancel_event.is_set():
+                            stream.close(wasted=False)
+                            break
+                    elif cancel_event.is_set() or spent + stream.token_count >= self.token_budget:
+                        stream.close()
+                        break
+            except (requests.RequestException, OllamaError):
+                return
+            finally:
+                spent += stream.token_count
+                metrics.increment("speculative_tokens", stream.token_count)
+            if detector.cutoff is not None:
+                record_choice_cutoff(stream, detector)
+            elif stream.final is None:
+                return
+            node = TreeNode(text.strip(), choice, parent=parent_node)
+            node.context = stream.context
+            node.telemetry = stream.telemetry
+            results[choice] = (prompt, node)
+
+    def take(self, parent_node, choice, prompt):
+        if parent_node.speculative_children is None:
+            return None
+        cached = parent_node.speculative_children.get(choice)
+        hit = cached is not None and cached[0] == prompt
+        metrics.increment("speculative_hits" if hit else "speculative_misses")
+        metrics.set_gauge("speculative_hit_rate", speculative_hit_rate())
+        return cached[1] if hit else None
+
+
+def speculative_hit_rate():
+    hits = metrics.get_counter("speculative_hits")
+    total = hits + metrics.get_counter("speculative_misses")
+    return hits / total if total else 0.0
@@ -0,0 +1,137 @@
+import sys
+
+import metrics
+from story_tree import UNLOADED
+
+
+def node_bytes(node):
+    # Estimated from what the node holds right now; text still on disk counts for nothing.
+    size = sys.getsizeof(node)
+    state = node._state
+    if state is not UNLOADED:
+        size += sys.getsizeof(state)
+    if node.summary is not None:
+        size += sys.getsizeof(node.summary)
+    if node._segment is not None:
+        size += sys.getsizeof(node._segment)
+    if node.context is not None:
+        # Context token ids are mostly too large for the small int cache, so each is its own object.
+        size += sys.getsizeof(node.context) + 28 * len(node.context)
+    if node.children:
+        size += sys.getsizeof(node.children)
+    if node.telemetry is not None:
+        size += sys.getsizeof(node.telemetry)
+    if node.speculative_children:
+        size += sys.getsizeof(node.speculative_children)
+        for prompt, speculative_node in tuple(node.speculative_children.values()):
+            size += sys.getsizeof(prompt) + node_bytes(speculative_node)
+    return size
+
+
+def subtree_bytes(root):
+    size = 0
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        size += node_bytes(node)
+        count += 1
+        stack.extend(node.children)
+    return size, count
+
+
+class BranchArchiver:
+    """Keeps the in-memory story tree under a byte budget by handing cold data back to the store."""
+
+    def __init__(self, store, budget_bytes=64 * 1024 * 1024, collect_every=10, keep_text_turns=20):
+        self.store = store
+        self.budget_bytes = budget_bytes
+        self.collect_every = collect_every
+        self.keep_text_turns = keep_text_turns
+        self.visits = {}
+        self.clock = 0
+        self.turns = 0
+
+    def touch(self, node):
+        # Recency is kept by row id so it never holds a spilled node in memory.
+        self.clock += 1
+        if node.node_id is not None:
+            self.visits[node.node_id] = self.clock
+
+    def turn_finished(self, current):
+        self.turns += 1
+        if self.turns % self.collect_every == 0:
+            self.collect(current)
+
+    def measure(self, current):
+        # Everything in memory hangs off the loaded part of the current path: the path itself
+        # and, beside it, whole side branches.
+        path = current.loaded_path_nodes()
+        on_path = set(map(id, path))
+        total = 0
+        count = 0
+        branches = []
+        for node in path:
+            total += node_bytes(node)
+            count += 1
+            for child in node.children:
+                if id(child) not in on_path:
+                    size, nodes = subtree_bytes(child)
+                    branches.append((self.visits.get(child.node_id, 0), node, child, size, nodes))
+                    total += size
+                    count += nodes
+        metrics.set_gauge("session_tree_bytes", total)
+        metrics.set_gauge("session_tree_nodes", count)
+        return total, path, branches
+
+    def collect(self, current):
+        total, path, branches = self.measure(current)
+        if total <= self.budget_bytes:
+            return total
+        # Spilled data must already be on disk before it is dropped here.
+        self.store.flush()
+        branches.sort(key=lambda branch: branch[0])
+        for _, parent, child, size, nodes in branches:
+            if total <= self.budget_bytes:
+                break
+            if child.node_id is None:
+                continue
+            parent.children.remove(child)
+            self.store.children_loaded.discard(parent.node_id)
+            self.store.forget(child)
+            total -= size
+            metrics.increment("archived_branches")
+            metrics.increment("archived_nodes", nodes)
+        # Past that, older turns on the path give up their Ollama context and then their text.
+        for node in path[:-1]:
+            if total <= self.budget_bytes:
+                break
+            if node.context is not None:
+                total -= sys.getsizeof(node.context) + 28 * len(node.context)
+                node.context = None
+        for node in path[:max(0, len(path) - self.keep_text_turns)]:
+            if total <= self.budget_bytes:
+                break
+            before = node_bytes(node)
+            node.release_text()
+            total -= before - node_bytes(node)
+        metrics.set_gauge("session_tree_bytes", total)
+        return total
+
+    def discard(self, node):
+        # A branch the player deleted is dropped from memory and from disk.
+        parent = node.parent
+        if parent is not None and node in parent.children:
+            parent.children.remove(node)
+        _, count = subtree_bytes(node)
+        self.visits.pop(node.node_id, None)
+        self.store.forget(node)
+        self.store.delete_subtree(node)
+        metrics.increment("discarded_nodes", count)
+
+    def end_session(self, current, session):
+        total, _, _ = self.measure(current)
+        metrics.observe("session_tree_bytes_at_end", total, metrics.SESSION_BYTES_BUCKETS)
+        self.store.forget_all()
+        self.store.delete_session(session)
+        self.visits.clear()
@@ -0,0 +1,130 @@
+import heapq
+import math
+import re
+
+import metrics
+
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have he her his i in is it its of on or that the their them "
+    "then there they this to was were what will with you your".split()
+)
+
+
+def tokenize(text):
+    return [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOPWORDS]
+
+
+class StoryIndex:
+    """BM25 inverted index over the scenes on the current story path."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.lengths = {}
+        self.terms = {}
+        self.total_length = 0
+        # Per word, its highest count in any scene; with the shortest scene length it caps what
+        # the word can add to a score. Removals leave the shortest length as it is, which only
+        # loosens the caps.
+        self.max_counts = {}
+        self.min_length = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __contains__(self, node):
+        return node in self.lengths
+
+    def add(self, node, state=None):
+        # state, when given, is the node's text, for a node whose text is not kept in memory.
+        if node in self.lengths:
+            self.remove(node)
+        counts = {}
+        for word in tokenize(node.state if state is None else state):
+            counts[word] = counts.get(word, 0) + 1
+        for word in tokenize(node.choice):
+            counts[word] = counts.get(word, 0) + 1
+        max_counts = self.max_counts
+        for word, count in counts.items():
+            self.postings.setdefault(word, {})[node] = count
+            if count > max_counts.get(word, 0):
+                max_counts[word] = count
+        length = sum(counts.values())
+        self.lengths[node] = length
+        if self.min_length is None or length < self.min_length:
+            self.min_length = length
+        self.terms[node] = tuple(counts)
+        self.total_length += length
+
+    def remove(self, node):
+        length = self.lengths.pop(node, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for word in self.terms.pop(node):
+            posting = self.postings[word]
+            del posting[node]
+            if not posting:
+                del self.postings[word]
+                del self.max_counts[word]
+
+    def clear(self):
+        self.postings.clear()
+        self.lengths.clear()
+        self.terms.clear()
+        self.total_length = 0
+        self.max_counts.clear()
+        self.min_length = None
+
+    def search(self, query, k=3, exclude=(), min_score=0.0):
+        count = len(self.lengths)
+        if not count:
+            return []
+        k1 = self.k1
+        lengths = self.lengths
+        base = k1 * (1 - self.b)
+        scale = k1 * self.b / (self.total_length / count or 1.0)
+        # A word adds at most weight * c / (c + shortest) to a score, c being its highest count.
+        shortest = base + scale * self.min_length
+        terms = []
+        for word in set(tokenize(query)):
+            posting = self.postings.get(word)
+            if not posting:
+                continue
+            df = len(posting)
+            weight = math.log(1 + (count - df + 0.5) / (df + 0.5)) * (k1 + 1)
+            most = self.max_counts[word]
+            terms.append((weight * most / (most + shortest), weight, posting))
+        # Rare words go first. Once a scene without a score cannot reach the top k through the
+        # words left, common words are only looked up for the scenes that still can.
+        terms.sort(key=lambda term: term[0], reverse=True)
+        threshold = min_score
+        scores = {}
+        for index, (cap, weight, posting) in enumerate(terms):
+            # Summed afresh rather than subtracted, so it is exactly 0 after the last word.
+            left = sum([term[0] for term in terms[index + 1:]])
+            if not scores and cap + left >= threshold:
+                scores = {node: weight * tf / (tf + base + scale * lengths[node]) for node, tf in posting.items()}
+            elif cap + left >= threshold:
+                for node, tf in posting.items():
+                    scores[node] = scores.get(node, 0.0) + weight * tf / (tf + base + scale * lengths[node])
+            else:
+                kept = {}
+                for node, score in scores.items():
+                    tf = posting.get(node)
+                    if tf is not None:
+                        score += weight * tf / (tf + base + scale * lengths[node])
+                    if score + left >= threshold:
+                        kept[node] = score
+                scores = kept
+            for node in exclude:
+                scores.pop(node, None)
+            if left and len(scores) >= k:
+                threshold = max(threshold, heapq.nlargest(k, scores.values())[-1])
+        metrics.increment("story_index_lookups")
+        # Scenes that only share a common word or two with the query are not worth recalling.
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [node for node, score in best if score >= min_score]
@@ -20,6 +20,10 @@ def get_priority_memory():
 def clear_priority_memory():
     priority_memory.clear()
 
+def restore_priority_memory(items):
+    priority_memory[:] = items
+    heapq.heapify(priority_memory)
+
 def remove_by_index(index):
     if 0<= index < len(priority_memory):
         priority_memory.pop(index)
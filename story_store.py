@@ -0,0 +1,320 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+from story_tree import TreeNode, UNLOADED
+from threat_manager import ThreatSnapshotTable, load_enemy_registry
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    head INTEGER
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL,
+    parent INTEGER,
+    choice TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT '',
+    summary TEXT,
+    threat_id INTEGER,
+    turn_counter INTEGER NOT NULL DEFAULT 0,
+    depth INTEGER NOT NULL DEFAULT 0,
+    jump INTEGER
+);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent);
+CREATE TABLE IF NOT EXISTS threat_snapshots (
+    session INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    last_threat INTEGER,
+    enemy_revealed INTEGER,
+    enemy_type TEXT,
+    enemy_defeated INTEGER,
+    memories TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (session, id)
+);
+"""
+
+# One recursive query walks parent links through the primary key, so loading a window of
+# ancestors costs one statement however deep the story is.
+ANCESTORS_QUERY = """
+WITH RECURSIVE chain(id, parent, distance) AS (
+    SELECT id, parent, 0 FROM nodes WHERE id = ?
+    UNION ALL
+    SELECT nodes.id, nodes.parent, chain.distance + 1 FROM nodes JOIN chain ON nodes.id = chain.parent
+    WHERE chain.distance + 1 < ?
+)
+SELECT nodes.id, nodes.parent, nodes.choice, nodes.summary, nodes.threat_id, nodes.turn_counter,
+       nodes.depth, nodes.jump
+FROM chain JOIN nodes ON nodes.id = chain.id ORDER BY chain.distance
+"""
+
+PATH_STATES_QUERY = """
+WITH RECURSIVE chain(id, parent) AS (
+    SELECT id, parent FROM nodes WHERE id = ?
+    UNION ALL
+    SELECT nodes.id, nodes.parent FROM nodes JOIN chain ON nodes.id = chain.parent
+)
+SELECT nodes.id, nodes.state FROM chain JOIN nodes ON nodes.id = chain.id
+"""
+
+CHILDREN_QUERY = """
+SELECT id, parent, choice, summary, threat_id, turn_counter, depth, jump
+FROM nodes WHERE parent = ? ORDER BY id
+"""
+
+DELETE_SUBTREE = """
+WITH RECURSIVE doomed(id) AS (
+    SELECT ?
+    UNION ALL
+    SELECT nodes.id FROM nodes JOIN doomed ON nodes.parent = doomed.id
+)
+DELETE FROM nodes WHERE id IN doomed
+"""
+
+
+class StoryStore:
+    """Write-through SQLite copy of the story tree. Writes are batched on a background thread."""
+
+    def __init__(self, path="story.db", window=64, batch_size=500, batch_interval=0.25):
+        self.path = path
+        self.window = window
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        # Reads happen on whichever thread touches an unloaded node, so they share one
+        # connection behind a lock; WAL lets them run while the writer commits.
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute("PRAGMA journal_mode=WAL")
+        self.reader.executescript(SCHEMA)
+        self.read_lock = threading.Lock()
+        self.next_node_id = (self.reader.execute("SELECT MAX(id) FROM nodes").fetchone()[0] or 0) + 1
+        self.saved_snapshots = {}
+        # Every stored node in memory, by row id, so parent, jump and child links resolve to one object.
+        self.nodes = {}
+        self.children_loaded = set()
+        self.writes = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.writes.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            done = []
+            stop = False
+            with connection:
+                for item in batch:
+                    if isinstance(item, threading.Event):
+                        done.append(item)
+                    elif item is None:
+                        stop = True
+                    else:
+                        connection.execute(*item)
+            metrics.increment("story_store_commits")
+            metrics.increment("story_store_writes", len(batch) - len(done))
+            for event in done:
+                event.set()
+            if stop:
+                connection.close()
+                return
+
+    def flush(self):
+        event = threading.Event()
+        self.writes.put(event)
+        event.wait()
+
+    def close(self):
+        self.writes.put(None)
+        self.thread.join()
+        self.reader.close()
+
+    def create_session(self):
+        with self.read_lock, self.reader:
+            return self.reader.execute("INSERT INTO sessions (head) VALUES (NULL)").lastrowid
+
+    def latest_session(self):
+        with self.read_lock:
+            row = self.reader.execute("SELECT MAX(id) FROM sessions WHERE head IS NOT NULL").fetchone()
+        return row[0]
+
+    def save_snapshots(self, session, snapshots):
+        saved = self.saved_snapshots.get(session, 0)
+        for snapshot_id in range(saved, len(snapshots.snapshots)):
+            last_threat, enemy_revealed, enemy_profile, enemy_defeated, memories = snapshots.snapshots[snapshot_id]
+            self.writes.put((
+                "INSERT OR REPLACE INTO threat_snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session, snapshot_id, last_threat, enemy_revealed,
+                 enemy_profile['type'] if enemy_profile else None, enemy_defeated, json.dumps(memories)),
+            ))
+        self.saved_snapshots[session] = len(snapshots.snapshots)
+
+    def add_node(self, session, node, snapshots):
+        node.node_id = self.next_node_id
+        self.next_node_id += 1
+        node.store = self
+        self.nodes[node.node_id] = node
+        self.save_snapshots(session, snapshots)
+        parent = node.parent
+        self.writes.put((
+            "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (node.node_id, session, parent.node_id if parent is not None else None, node.choice,
+             node.state, node.summary, node.threat_id, node.turn_counter, node.depth, node.jump.node_id),
+        ))
+
+    def delete_subtree(self, node):
+        if node.node_id is not None:
+            self.writes.put((DELETE_SUBTREE, (node.node_id,)))
+
+    def delete_session(self, session):
+        # A cleared story is not kept on disk: its turns, threat snapshots and head all go.
+        self.writes.put(("DELETE FROM nodes WHERE session = ?", (session,)))
+        self.writes.put(("DELETE FROM threat_snapshots WHERE session = ?", (session,)))
+        self.writes.put(("DELETE FROM sessions WHERE id = ?", (session,)))
+        self.saved_snapshots.pop(session, None)
+
+    def forget(self, node):
+        # Drops an in-memory subtree from the identity map so nothing here keeps it alive.
+        stack = [node]
+        count = 0
+        while stack:
+            node = stack.pop()
+            self.nodes.pop(node.node_id, None)
+            self.children_loaded.discard(node.node_id)
+            stack.extend(node.children)
+            count += 1
+        return count
+
+    def forget_all(self):
+        self.nodes.clear()
+        self.children_loaded.clear()
+
+    def update_state(self, node):
+        if node.node_id is not None:
+            self.writes.put(("UPDATE nodes SET state = ?, summary = NULL WHERE id = ?", (node.state, node.node_id)))
+
+    def update_snapshot(self, session, node, snapshots):
+        if node.node_id is not None:
+            self.save_snapshots(session, snapshots)
+            self.writes.put(("UPDATE nodes SET threat_id = ? WHERE id = ?", (node.threat_id, node.node_id)))
+
+    def update_summary(self, node):
+        if node.node_id is not None:
+            self.writes.put(("UPDATE nodes SET summary = ? WHERE id = ?", (node.summary, node.node_id)))
+
+    def set_head(self, session, node):
+        self.writes.put(("UPDATE sessions SET head = ? WHERE id = ?", (node.node_id, session)))
+
+    def load_state(self, node_id):
+        metrics.increment("story_store_text_loads")
+        with self.read_lock:
+            return self.reader.execute("SELECT state FROM nodes WHERE id = ?", (node_id,)).fetchone()[0]
+
+    def load_window(self, node_id, window=None):
+        # Builds up to `window` nodes, nearest first, linked to each other; the oldest keeps its
+        # parent's id so the next window loads only when something walks that far back. Loading
+        # stops early at a node that is already in memory.
+        node = self.nodes.get(node_id)
+        if node is not None:
+            return node
+        with self.read_lock:
+            rows = self.reader.execute(ANCESTORS_QUERY, (node_id, window or self.window)).fetchall()
+        metrics.increment("story_store_ancestor_loads")
+        first = previous = None
+        for row in rows:
+            node = self.nodes.get(row[0])
+            loaded = node is not None
+            if not loaded:
+                node = self.node_from_row(row)
+            if previous is not None:
+                previous.parent = node
+                self.adopt(node, previous)
+            if first is None:
+                first = node
+            if loaded:
+                break
+            previous = node
+        return first
+
+    def node_from_row(self, row):
+        row_id, parent_id, choice, summary, threat_id, turn_counter, depth, jump_id = row
+        node = TreeNode(UNLOADED, choice, threat_id=threat_id, parent=parent_id, turn_counter=turn_counter)
+        node.node_id = row_id
+        node.store = self
+        node.summary = summary
+        node.depth = depth
+        if jump_id is not None and jump_id != row_id:
+            node._jump = jump_id
+        self.nodes[row_id] = node
+        return node
+
+    def load_children(self, node):
+        # Opening a story only follows the head's ancestors; branches beside them load here.
+        if node.node_id is None or node.node_id in self.children_loaded:
+            return node.children
+        with self.read_lock:
+            rows = self.reader.execute(CHILDREN_QUERY, (node.node_id,)).fetchall()
+        for row in rows:
+            child = self.nodes.get(row[0]) or self.node_from_row(row)
+            child.parent = node
+            self.adopt(node, child)
+        # Children already in memory were adopted first; row order makes sibling order the same
+        # however the branch was reached. Nodes not yet stored are the newest and go last.
+        node.children.sort(key=lambda child: (child.node_id is None, child.node_id or 0))
+        self.children_loaded.add(node.node_id)
+        return node.children
+
+    def adopt(self, parent, child):
+        if not parent.children:
+            parent.children = [child]
+        elif child not in parent.children:
+            parent.children.append(child)
+
+    def load_node(self, node_id):
+        return self.load_window(node_id)
+
+    def load_ancestors(self, node, parent_id, window=None):
+        parent = self.load_window(parent_id, window)
+        self.adopt(parent, node)
+        return parent
+
+    def load_path_states(self, node):
+        # Loads every ancestor of a stored node in one statement and returns the text of the
+        # whole path by row id, leaving it on disk rather than on the nodes.
+        if node._parent.__class__ is int:
+            node.parent = self.load_ancestors(node, node._parent, node.depth)
+        with self.read_lock:
+            return dict(self.reader.execute(PATH_STATES_QUERY, (node.node_id,)).fetchall())
+
+    def load_snapshots(self, session):
+        table = ThreatSnapshotTable()
+        registry = load_enemy_registry()
+        profiles = {profile['type']: profile for profile in registry.profiles}
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT id, last_threat, enemy_revealed, enemy_type, enemy_defeated, memories FROM threat_snapshots "
+                "WHERE session = ? ORDER BY id", (session,)
+            ).fetchall()
+        for snapshot_id, last_threat, enemy_revealed, enemy_type, enemy_defeated, memories in rows:
+            profile = profiles.get(enemy_type)
+            memories = tuple(tuple(item) for item in json.loads(memories))
+            table.ids[(last_threat, bool(enemy_revealed), bool(enemy_defeated), enemy_type, memories)] = snapshot_id
+            table.snapshots.append((last_threat, bool(enemy_revealed), profile, bool(enemy_defeated), memories))
+        self.saved_snapshots[session] = len(table.snapshots)
+        return table
+
+    def open_session(self, session):
+        # Only the head's nearest ancestors are read; text and older turns load on demand.
+        with self.read_lock:
+            head_id = self.reader.execute("SELECT head FROM sessions WHERE id = ?", (session,)).fetchone()[0]
+        return self.load_window(head_id), self.load_snapshots(session)
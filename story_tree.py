@@ -1,73 +1,291 @@
-import requests
-import json
+import re
+import sys
+
+import metrics
+from ollama_client import default_client, default_async_client, OllamaStream
 
 system_prompt = """
 You are a Fantasy Dungeon Narrator and the following are to be used as your system prompt, 
 TASK: You will narrate an adventure story that takes place inside a vast dungeon that has many biomes, like a forest, a glacier, a desert,a volcano, etc. Player will make choices that will affect the story..
 """
 
-def query_ollama(prompt, model="mistral"):
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "prompt": prompt,
-            "model": model,
-            "stream": False
-        }
-    )
-    return response.json()
-
-def query_ollama_streaming(prompt, model="mistral"):
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "prompt": prompt,
-            "model": model,
-            "stream": True
-        },
-        stream=True
-    )
-    for line in response.iter_lines():
-        if line:
-            yield json.loads(line.decode('utf-8'))['response']
+def query_ollama(prompt, model="mistral", client=None, context=None, options=None):
+    client = client or default_client
+    return client.generate(prompt, model=model, context=context, options=options)
+
+def query_ollama_streaming(prompt, model="mistral", client=None, context=None, options=None, resume_prompt=None):
+    client = client or default_client
+    return OllamaStream(client.generate_streaming(prompt, model=model, context=context, options=options,
+                                                  resume_prompt=resume_prompt))
+
+def async_query_ollama_streaming(prompt, model="mistral", client=None, context=None, options=None):
+    client = client or default_async_client
+    return OllamaStream(client.generate_streaming(prompt, model=model, context=context, options=options))
+
+# Placeholder for narration text that is still on disk; see StoryStore.
+UNLOADED = object()
 
 class TreeNode:
-    def __init__(self, state, choice, threat_state=None, parent=None):
-        self.state = state
-        self.choice = choice
-        self.threat_state = threat_state
-        self.children = []
-        self.parent = parent
+    __slots__ = ("children", "_state", "choice", "threat_id", "turn_counter", "_parent", "context",
+                 "speculative_children", "telemetry", "summary", "revision", "_segment", "node_id", "store",
+                 "depth", "_jump")
+
+    def __init__(self, state, choice, threat_id=None, parent=None, turn_counter=0):
+        # Leaves far outnumber branches, so children stays a shared empty tuple until the first add.
+        self.children = ()
+        self._state = state
+        self.choice = sys.intern(choice)
+        self.threat_id = threat_id
+        self.turn_counter = turn_counter
+        self._parent = parent
+        self.context = None
+        self.speculative_children = None
+        self.telemetry = None
+        self.summary = None
+        self.revision = 0
+        self._segment = None
+        self.node_id = None
+        self.store = None
+        self.depth = 0
+        self._jump = self
+        if parent is not None and parent.__class__ is not int:
+            self.link_to(parent)
+
+    @property
+    def state(self):
+        if self._state is UNLOADED:
+            self._state = self.store.load_state(self.node_id)
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+        self._segment = None
+        self.revision += 1
+        self.invalidate_summaries()
+
+    @property
+    def parent(self):
+        # Nodes opened from a StoryStore hold their parent's row id until it is first needed.
+        parent = self._parent
+        if parent.__class__ is int:
+            parent = self._parent = self.store.load_ancestors(self, parent)
+        return parent
+
+    @parent.setter
+    def parent(self, value):
+        self._parent = value
+
+    @property
+    def jump(self):
+        jump = self._jump
+        if jump.__class__ is int:
+            jump = self._jump = self.store.load_node(jump)
+        return jump
+
+    def link_to(self, parent):
+        # One skew-binary jump pointer per node (Myers' scheme) instead of a binary lifting table:
+        # the same O(log n) ancestor and LCA queries with a single extra reference per node.
+        self.depth = parent.depth + 1
+        jump = parent.jump
+        if parent.depth - jump.depth == jump.depth - jump.jump.depth:
+            self._jump = jump.jump
+        else:
+            self._jump = parent
+
+    def ancestor_at_depth(self, depth):
+        if depth > self.depth or depth < 0:
+            return None
+        node = self
+        while node.depth > depth:
+            jump = node.jump
+            node = jump if jump.depth >= depth else node.parent
+        return node
+
+    def lowest_common_ancestor(self, other):
+        a, b = self, other
+        if a.depth > b.depth:
+            a = a.ancestor_at_depth(b.depth)
+        elif b.depth > a.depth:
+            b = b.ancestor_at_depth(a.depth)
+        # Nodes at equal depth have jump pointers of equal depth, so both sides move together.
+        while a is not b:
+            if a.jump is not b.jump:
+                a, b = a.jump, b.jump
+            else:
+                a, b = a.parent, b.parent
+                if a is None or b is None:
+                    return None
+        return a
+
+    def invalidate_summaries(self):
+        # Every summary below this node was folded from this node's old text.
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.summary = None
+            stack.extend(node.children)
 
     def add_child(self, child_node):
         child_node.parent = self
-        self.children.append(child_node)
+        child_node.link_to(self)
+        if self.children:
+            self.children.append(child_node)
+        else:
+            self.children = [child_node]
+
+    def path_segment(self):
+        if self._segment is None:
+            self._segment = render_path_segment(self.state, self.choice, self.parent is None)
+        return self._segment
+
+    def path_nodes(self, from_depth=0):
+        nodes = [None] * (self.depth - from_depth + 1)
+        node = self
+        for index in range(len(nodes) - 1, -1, -1):
+            nodes[index] = node
+            node = node.parent
+        return nodes
+
+    def loaded_path_nodes(self):
+        # Like path_nodes, but stops at the first ancestor that is still on disk.
+        nodes = [self]
+        while nodes[-1]._parent is not None and nodes[-1]._parent.__class__ is not int:
+            nodes.append(nodes[-1]._parent)
+        nodes.reverse()
+        return nodes
+
+    def release_text(self):
+        # Only for stored nodes whose text has been written; the next read loads it again.
+        if self.store is not None and self.node_id is not None:
+            self._state = UNLOADED
+            self._segment = None
 
     def getPath(self):
         node = self
         path = []
         while node is not None:
-            path.append((node.state, node.choice, node.threat_state))
+            path.append((node.state, node.choice, node.threat_id))
             node = node.parent
         path.reverse()
         return path        
 
-def build_path_from_prompt(path):
-    prompt = "Here is the full story path so far for your context:\n"
-    for i, (state, choice, _) in enumerate(path):
-        if i == 0 and choice.lower() == "start":
-            prompt += f"{state}\n"
-        else:
-            prompt += f"The player was presented with this situation:\n{state.strip()}\n"
-            prompt += f"The player responded with: {choice.strip()}\n"
-    
-    prompt += "\nThis is the story context to keep in mind. Now, continue the story based on the latest player choice and the current situation.\n"
-    return prompt
+def path_between(source, target):
+    # The nodes walked from source up to their common ancestor, and from there down to target.
+    ancestor = source.lowest_common_ancestor(target)
+    if ancestor is None:
+        return None, [], []
+    up = []
+    node = source
+    while node is not ancestor:
+        up.append(node)
+        node = node.parent
+    return ancestor, up, target.path_nodes(ancestor.depth + 1)
+
+PATH_PROMPT_HEADER = "Here is the full story path so far for your context:\n"
+PATH_PROMPT_FOOTER = "\nThis is the story context to keep in mind. Now, continue the story based on the latest player choice and the current situation.\n"
+
+def render_path_segment(state, choice, is_first):
+    if is_first and choice.lower() == "start":
+        return f"{state}\n"
+    return (f"The player was presented with this situation:\n{state.strip()}\n"
+            f"The player responded with: {choice.strip()}\n")
+
+def build_summary_segment(summary):
+    return f"Summary of the story before the turns below:\n{summary.strip()}\n\n" if summary else ""
+
+def build_path_from_prompt(path, summary=None):
+    segments = [render_path_segment(state, choice, i == 0) for i, (state, choice, _) in enumerate(path)]
+    return "".join([PATH_PROMPT_HEADER, build_summary_segment(summary), *segments, PATH_PROMPT_FOOTER])
+
+def build_path_from_nodes(nodes, summary=None):
+    # Same text as build_path_from_prompt, joined from each node's cached segment.
+    return "".join([PATH_PROMPT_HEADER, build_summary_segment(summary), *[node.path_segment() for node in nodes], PATH_PROMPT_FOOTER])
+
+def split_path_at_summary(node, raw_turns=3):
+    # Returns the nearest summary at least raw_turns back and the nodes after it,
+    # or no summary and the whole path when no such ancestor has one yet.
+    tail = []
+    while node is not None:
+        if len(tail) >= raw_turns and node.summary is not None:
+            tail.reverse()
+            return node.summary, tail
+        tail.append(node)
+        node = node.parent
+    tail.reverse()
+    return None, tail
 
 def build_current_prompt(state, choice):
     prompt = "The player was presented with this situation:\n"
     prompt += f"{state.strip()}\n"
-    prompt += f"The player responded with: {choice.strip()}\n"
+    return prompt + build_choice_prompt(choice)
+
+def build_choice_prompt(choice):
+    prompt = f"The player responded with: {choice.strip()}\n"
     prompt += "\nNarrate the next scene and then present exactly three distinct and numbered choices the player can make next.\n"
     prompt += "Do not continue the story after giving the three options. Wait for the player's next decision.\n"
-    return prompt
\ No newline at end of file
+    return prompt
+
+# A numbered option either starts a line or follows the previous one inline, as in
+# "What will you do? 1) Rest, 2) Run, 3) Hide".
+OPTION_PATTERN = re.compile(r'(?:^|[\s,;:])\W*([123])\s*[.)]\s*\S')
+
+def parse_choices(text):
+    choices = {}
+    for line in text.splitlines():
+        matches = list(OPTION_PATTERN.finditer(line))
+        for match, following in zip(matches, matches[1:] + [None]):
+            end = following.start() if following is not None else len(line)
+            choices.setdefault(match.group(1), line[match.end() - 1:end].strip(" *,;"))
+    return choices
+
+class ThirdChoiceDetector:
+    """Finds where the line holding the third numbered option ends in a streamed narration."""
+
+    option_pattern = OPTION_PATTERN
+
+    def __init__(self, grace_tokens=16):
+        self.text = ""
+        self.line_start = 0
+        self.expected = "1"
+        self.grace_tokens = grace_tokens
+        self.cutoff = None
+        self.cutoff_tokens = 0
+
+    def feed(self, chunk, token_count=0):
+        # token_count is the stream's count including this chunk.
+        self.text += chunk
+        while True:
+            end = self.text.find("\n", self.line_start)
+            if end < 0:
+                return None
+            line = self.text[self.line_start:end]
+            self.line_start = end + 1
+            # Options must appear in order; a new "1" restarts the list.
+            for number in self.option_pattern.findall(line):
+                if number == "1":
+                    self.expected = "2"
+                elif number == self.expected:
+                    self.expected = "3" if number == "2" else None
+            if self.expected is None:
+                self.cutoff = end
+                self.cutoff_tokens = token_count
+                return end
+
+    def should_close(self, token_count):
+        # Models usually stop right after the options. The stream is left open for a few more
+        # tokens so the final chunk, with the context and the timings, can still arrive.
+        return self.cutoff is not None and token_count - self.cutoff_tokens > self.grace_tokens
+
+def record_choice_cutoff(stream, detector):
+    # Counts the tokens received after the third option and dropped from the narration. What a
+    # stream closed early would still have generated is never known, so it is not counted.
+    trimmed = stream.token_count - detector.cutoff_tokens
+    metrics.increment("cutoff_trimmed_tokens", trimmed)
+    if stream.final is None:
+        metrics.increment("choice_cutoffs")
+        if stream.telemetry is None:
+            stream.record_client_telemetry()
+    if stream.telemetry is not None:
+        stream.telemetry["cutoff_trimmed_tokens"] = trimmed
+    return trimmed
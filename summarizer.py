@@ -0,0 +1,129 @@
+import queue
+import threading
+
+import requests
+
+import metrics
+from ollama_client import OllamaError
+from story_tree import query_ollama_streaming
+
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a dungeon adventure. "
+    "Update the summary with the newest turn. Keep every fact that matters later: places, items, injuries, enemies and choices. "
+    "Write at most {max_words} words of plain prose and nothing else.\n\n"
+    "Summary so far:\n{summary}\n\n"
+    "Newest turn:\nThe player chose: {choice}\nWhat happened: {state}\n\n"
+    "Updated summary:"
+)
+
+
+class RollingSummarizer:
+    """Folds each finished turn into its parent's summary on a background thread."""
+
+    def __init__(self, client, max_words=150, options=None, max_chain=12, on_summary=None):
+        self.client = client
+        self.max_words = max_words
+        self.max_chain = max_chain
+        self.on_summary = on_summary
+        self.options = options if options is not None else {"num_predict": 256, "temperature": 0.2}
+        self.jobs = queue.Queue()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.active_stream = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, node):
+        if node.state:
+            self.jobs.put(node)
+
+    def pause(self):
+        # A narration is starting on the same backend: no summary starts until resume(), and one
+        # already generating is abandoned and redone later.
+        self.idle.clear()
+        stream = self.active_stream
+        if stream is not None:
+            try:
+                stream.close()
+            except ValueError:
+                # A plain generator cannot be closed while the worker is inside it; the worker
+                # then stops at its next chunk instead.
+                pass
+
+    def resume(self):
+        self.idle.set()
+
+    def run(self):
+        while True:
+            node = self.jobs.get()
+            self.idle.wait()
+            try:
+                if not self.summarize(node):
+                    self.jobs.put(node)
+            except (requests.RequestException, OllamaError):
+                metrics.increment("summary_failures")
+
+    def generate(self, prompt):
+        # Returns None when a narration interrupted the summary.
+        if not self.idle.is_set():
+            return None
+        stream = self.active_stream = query_ollama_streaming(prompt, client=self.client, options=self.options)
+        text = ""
+        try:
+            for chunk in stream:
+                if not self.idle.is_set():
+                    break
+                text += chunk
+        except (requests.RequestException, OllamaError):
+            # pause() dropped the connection while the worker waited for the next token.
+            if self.idle.is_set():
+                raise
+        finally:
+            self.active_stream = None
+            stream.close()
+        if stream.final is None:
+            metrics.increment("summaries_interrupted")
+            return None
+        return text.strip()
+
+    def summarize(self, node):
+        # Missing ancestor summaries are filled in first, oldest to newest, so each node
+        # folds in the summary of its own branch. A story reopened from disk without summaries
+        # is only summarised from max_chain turns back. Returns False when a narration
+        # interrupted it, so it can be submitted again.
+        chain = []
+        while node is not None and node.summary is None and len(chain) < self.max_chain:
+            chain.append(node)
+            node = node.parent
+        for node in reversed(chain):
+            parent_summary = node.parent.summary if node.parent is not None else None
+            if not node.state:
+                # A defeat turn, or a narration stopped before its first token, adds nothing, so
+                # it carries its parent's summary on to the turns below it.
+                if parent_summary is not None:
+                    node.summary = parent_summary
+                    if self.on_summary is not None:
+                        self.on_summary(node)
+                continue
+            revision = node.revision
+            prompt = SUMMARY_PROMPT.format(
+                max_words=self.max_words,
+                summary=parent_summary or ("(the adventure has just begun)" if node.parent is None else "(nothing summarised yet)"),
+                choice=node.choice.strip(),
+                state=node.state.strip(),
+            )
+            summary = self.generate(prompt)
+            if summary is None:
+                return False
+            if not summary:
+                return True
+            # The node may have been rewritten, or its parent re-summarized, while this ran.
+            if node.revision != revision or (node.parent is not None and node.parent.summary is not parent_summary):
+                metrics.increment("summaries_discarded")
+                return True
+            node.summary = summary
+            metrics.increment("summaries_built")
+            if self.on_summary is not None:
+                self.on_summary(node)
+        return True
@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import metrics
+from standin import StandInOllama
+
+
+@pytest.fixture
+def standins():
+    servers = []
+
+    def start(**kwargs):
+        server = StandInOllama(**kwargs)
+        servers.append(server)
+        return server
+
+    metrics.clear_metrics()
+    yield start
+    for server in servers:
+        server.close()
+
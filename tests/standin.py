@@ -0,0 +1,138 @@
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from ollama_client import OllamaClient
+
+TEXT = ("The corridor narrows and torches flicker along the damp walls. A faint sound echoes ahead. "
+        "What will you do? 1) Follow the sound 2) Inspect the torches 3) Turn back")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standin = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_json({"version": "0.0.0"})
+
+    def do_POST(self):
+        standin = self.standin
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with standin.lock:
+            standin.requests.append(payload)
+        if standin.status != 200:
+            self.send_json({"error": "stand-in failure"}, standin.status)
+            return
+        words = [word + " " for word in standin.text.split(" ")]
+        if payload.get("raw"):
+            # A resumed request: continue after the words already in the prompt.
+            done = payload["prompt"].split("[/INST]", 1)[1]
+            words = words[len(done.split(" ")) - 1:]
+        if not self.wait_for_first_token():
+            return
+        final = {"response": "", "done": True, "context": [1, 2, 3], "eval_count": len(words), "eval_duration": 1000000}
+        if not payload.get("stream", True):
+            self.send_json(dict(final, response="".join(words)))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for index, word in enumerate(words):
+                if standin.drop_after == index and not payload.get("raw"):
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+                    return
+                self.write_chunk({"response": word, "done": False})
+                time.sleep(standin.delay)
+            self.write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            standin.count("completed")
+        except OSError:
+            standin.count("aborted")
+
+    def wait_for_first_token(self):
+        # Ollama sends nothing, not even headers, while it evaluates the prompt.
+        deadline = time.monotonic() + self.standin.first_token_delay
+        while time.monotonic() < deadline:
+            time.sleep(0.01)
+            try:
+                gone = self.connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+            except BlockingIOError:
+                gone = False
+            except OSError:
+                gone = True
+            if gone:
+                self.standin.count("aborted")
+                self.close_connection = True
+                return False
+        return True
+
+    def write_chunk(self, chunk):
+        line = json.dumps(chunk).encode("utf-8") + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandInOllama:
+    """A local HTTP server that answers /api/generate the way Ollama streams a narration."""
+
+    def __init__(self, text=TEXT, delay=0.0, first_token_delay=0.0, status=200, drop_after=None, port=0):
+        self.text = text
+        self.delay = delay
+        self.first_token_delay = first_token_delay
+        self.status = status
+        self.drop_after = drop_after
+        self.requests = []
+        self.counts = {}
+        self.lock = threading.Lock()
+        handler = type("Handler", (StandInHandler,), {"standin": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def wait_for(self, name, value=1, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while self.counts.get(name, 0) < value and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.counts.get(name, 0)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_client(*urls, **kwargs):
+    kwargs.setdefault("max_retries", 0)
+    kwargs.setdefault("resume_backoff", 0)
+    return OllamaClient(base_urls=list(urls), **kwargs)
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import shutil
+import ssl
+import subprocess
+
+import pytest
+
+import metrics
+from ollama_client import AsyncOllamaClient
+
+WORDS = ["The ", "door ", "creaks ", "open. ", "1) Enter ", "2) Wait ", "3) Leave"]
+
+
+def chunked_body(words):
+    lines = [json.dumps({"response": word, "done": False}).encode() + b"\n" for word in words]
+    lines.append(json.dumps({"response": "", "done": True, "context": [1, 2]}).encode() + b"\n")
+    return b"".join(b"%x\r\n%s\r\n" % (len(line), line) for line in lines) + b"0\r\n\r\n"
+
+
+class StandInServer:
+    """An asyncio stand-in for Ollama that writes a chunked response in pieces of split_size bytes."""
+
+    def __init__(self, split_size=None, answer_reused=True):
+        self.split_size = split_size
+        self.answer_reused = answer_reused
+        self.requests = 0
+        self.connections = 0
+
+    async def start(self, ssl_context=None):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0, ssl=ssl_context)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        served = 0
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = next(int(line.split(b":")[1]) for line in head.split(b"\r\n")
+                              if line.lower().startswith(b"content-length"))
+                await reader.readexactly(length)
+                self.requests += 1
+                if served and not self.answer_reused:
+                    # Behaves like a keep-alive connection the server closed while it was idle.
+                    return
+                served += 1
+                response = (b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                            b"Transfer-Encoding: chunked\r\n\r\n" + chunked_body(WORDS))
+                step = self.split_size or len(response)
+                for start in range(0, len(response), step):
+                    writer.write(response[start:start + step])
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def collect(client, prompt="go"):
+    return [chunk async for chunk in client.generate_streaming(prompt)]
+
+
+@pytest.mark.parametrize("split_size", [None, 1, 7])
+def test_chunked_body_is_decoded_across_any_read_boundary(split_size):
+    async def run():
+        server = StandInServer(split_size)
+        port = await server.start()
+        client = AsyncOllamaClient(base_url=f"http://127.0.0.1:{port}")
+        chunks = await collect(client)
+        await client.close()
+        await server.close()
+        return chunks
+
+    chunks = asyncio.run(run())
+    assert "".join(chunk["response"] for chunk in chunks) == "".join(WORDS)
+    assert chunks[-1]["done"] and chunks[-1]["context"] == [1, 2]
+
+
+def test_stale_keep_alive_connection_is_resent_on_a_new_one():
+    async def run():
+        server = StandInServer(answer_reused=False)
+        port = await server.start()
+        client = AsyncOllamaClient(base_url=f"http://127.0.0.1:{port}")
+        first = await collect(client, "a")
+        second = await collect(client, "b")
+        await client.close()
+        await server.close()
+        return server, first, second
+
+    metrics.clear_metrics()
+    server, first, second = asyncio.run(run())
+    assert first[-1]["done"] and second[-1]["done"]
+    assert metrics.get_counter("stale_connections") == 1
+    assert server.connections == 2 and server.requests == 3
+
+
+def test_unsupported_scheme_is_rejected():
+    with pytest.raises(ValueError):
+        AsyncOllamaClient(base_url="ftp://127.0.0.1:11434")
+
+
+@pytest.mark.skipif(shutil.which("openssl") is None, reason="needs openssl to make a certificate")
+def test_https_backend_is_reached_over_tls(tmp_path):
+    cert, key = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+
+    async def run():
+        server = StandInServer()
+        port = await server.start(server_context)
+        client = AsyncOllamaClient(base_url=f"https://127.0.0.1:{port}",
+                                   ssl_context=ssl.create_default_context(cafile=cert))
+        chunks = await collect(client)
+        await client.close()
+        await server.close()
+        return chunks
+
+    chunks = asyncio.run(run())
+    assert "".join(chunk["response"] for chunk in chunks) == "".join(WORDS)
@@ -0,0 +1,52 @@
+from ollama_client import BackendPool
+from story_tree import query_ollama_streaming
+from standin import TEXT, make_client, unused_port
+
+
+def test_routes_to_the_least_busy_backend(standins):
+    first, second = standins(delay=0.05), standins(delay=0.05)
+    client = make_client(first.url, second.url)
+    streams = [iter(query_ollama_streaming(f"turn {i}", client=client)) for i in range(2)]
+    for stream in streams:
+        next(stream)
+    assert [backend.outstanding for backend in client.backends.backends] == [1, 1]
+    assert len(first.requests) == len(second.requests) == 1
+    for stream in streams:
+        stream.close()
+
+
+def test_pool_prefers_healthy_backends_with_fewest_outstanding():
+    pool = BackendPool(["http://a", "http://b", "http://c"], max_failures=1)
+    a, b, c = pool.backends
+    assert pool.acquire() is a
+    assert pool.acquire() is b
+    pool.mark_failed(c)
+    assert pool.acquire() is a
+    pool.release(a)
+    pool.release(a)
+    assert pool.acquire(exclude=[a]) is b
+
+
+def test_failover_before_first_token(standins):
+    failing = standins(status=500)
+    working = standins()
+    client = make_client(failing.url, working.url)
+    assert "".join(query_ollama_streaming("go", client=client)) == TEXT + " "
+    assert len(failing.requests) == 1
+    assert [backend.failures for backend in client.backends.backends] == [1, 0]
+
+
+def test_unreachable_backend_is_ejected_and_readmitted(standins):
+    port = unused_port()
+    working = standins()
+    client = make_client(f"http://127.0.0.1:{port}", working.url, max_failures=2)
+    down = client.backends.backends[0]
+    for _ in range(2):
+        assert "".join(query_ollama_streaming("go", client=client)) == TEXT + " "
+    assert not down.healthy
+
+    client.check_health()
+    assert not down.healthy
+    standins(port=port)
+    client.check_health()
+    assert down.healthy and down.failures == 0
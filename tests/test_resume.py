@@ -0,0 +1,46 @@
+import pytest
+import requests
+
+import metrics
+from story_tree import query_ollama_streaming
+from standin import TEXT, make_client
+
+
+def test_mid_stream_drop_resumes_in_raw_mode(standins):
+    server = standins(drop_after=5)
+    client = make_client(server.url)
+    stream = query_ollama_streaming("go", client=client)
+    assert "".join(stream) == TEXT + " "
+    assert stream.final is not None
+    assert metrics.get_counter("resumed_streams") == 1
+    resumed = server.requests[-1]
+    assert resumed["raw"] and resumed["prompt"].startswith("[INST] go [/INST]The corridor")
+    assert "context" not in resumed
+
+
+def test_mid_stream_drop_with_context_is_not_resumed(standins):
+    server = standins(drop_after=5)
+    client = make_client(server.url)
+    with pytest.raises(requests.RequestException):
+        "".join(query_ollama_streaming("go", client=client, context=[1, 2, 3]))
+    assert len(server.requests) == 1
+
+
+def test_mid_stream_drop_with_context_resumes_from_the_full_prompt(standins):
+    server = standins(drop_after=5)
+    client = make_client(server.url)
+    stream = query_ollama_streaming("choice only", client=client, context=[1, 2, 3], resume_prompt="full turn")
+    assert "".join(stream) == TEXT + " "
+    assert server.requests[0]["prompt"] == "choice only" and server.requests[0]["context"] == [1, 2, 3]
+    resumed = server.requests[-1]
+    assert resumed["raw"] and resumed["prompt"].startswith("[INST] full turn [/INST]The corridor")
+    assert "context" not in resumed
+
+
+def test_unknown_model_is_not_resumed(standins):
+    server = standins(drop_after=5)
+    client = make_client(server.url)
+    with pytest.raises(requests.RequestException):
+        "".join(query_ollama_streaming("go", model="phi3", client=client))
+    assert len(server.requests) == 1
+
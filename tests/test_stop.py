@@ -0,0 +1,58 @@
+import threading
+import time
+
+import metrics
+from single_flight import CoalescingClient
+from story_tree import query_ollama_streaming
+from standin import TEXT, make_client
+
+
+def test_stop_aborts_generation_and_releases_the_connection(standins):
+    server = standins(delay=0.05)
+    client = make_client(server.url, pool_maxsize=1)
+    stream = query_ollama_streaming("go", client=client)
+    pieces = iter(stream)
+    next(pieces)
+    next(pieces)
+    stream.stop()
+    assert server.wait_for("aborted") == 1
+    assert client.backends.backends[0].outstanding == 0
+    assert metrics.get_counter("stopped_generations") == 1
+    assert metrics.get_counter("stopped_tokens") == 2
+    assert metrics.get_counter("wasted_tokens") == 0
+
+    # With a single pooled connection, the next request only gets through if Stop released it.
+    server.delay = 0
+    result = []
+    thread = threading.Thread(target=lambda: result.append("".join(query_ollama_streaming("again", client=client))))
+    thread.start()
+    thread.join(5)
+    assert result == [TEXT + " "]
+
+
+def test_stop_before_first_token_drops_the_request(standins):
+    server = standins(first_token_delay=5)
+    client = CoalescingClient(make_client(server.url))
+    stream = query_ollama_streaming("go", client=client)
+    time.sleep(0.2)
+    started = time.monotonic()
+    stream.stop()
+    assert server.wait_for("aborted") == 1
+    assert time.monotonic() - started < 1
+    assert metrics.get_counter("stopped_generations") == 1
+    assert metrics.get_counter("stopped_tokens") == 0
+
+
+
+
+def test_discarded_generation_counts_wasted_tokens(standins):
+    server = standins(delay=0.05)
+    stream = query_ollama_streaming("go", client=make_client(server.url))
+    pieces = iter(stream)
+    for _ in range(3):
+        next(pieces)
+    stream.close()
+    assert server.wait_for("aborted") == 1
+    assert metrics.get_counter("cancelled_generations") == 1
+    assert metrics.get_counter("wasted_tokens") == 3
+    assert metrics.get_counter("stopped_generations") == 0
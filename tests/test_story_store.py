@@ -0,0 +1,43 @@
+from story_store import StoryStore
+from story_tree import TreeNode
+from threat_manager import ThreatSnapshotTable
+
+
+def test_children_keep_row_order_whichever_loaded_first(tmp_path):
+    store = StoryStore(str(tmp_path / "story.db"))
+    session = store.create_session()
+    snapshots = ThreatSnapshotTable()
+    root = TreeNode("You stand in a dungeon.", "Start")
+    store.add_node(session, root, snapshots)
+    for choice in ("left", "right", "down"):
+        child = TreeNode(f"You go {choice}.", choice, parent=root)
+        root.add_child(child)
+        store.add_node(session, child, snapshots)
+    store.set_head(session, root.children[2])
+    store.flush()
+    store.close()
+
+    store = StoryStore(str(tmp_path / "story.db"))
+    head, _ = store.open_session(session)
+    # The head's parent already holds the head before its other children are read.
+    assert [child.choice for child in store.load_children(head.parent)] == ["left", "right", "down"]
+    store.close()
+
+
+def test_deleted_session_leaves_no_rows(tmp_path):
+    store = StoryStore(str(tmp_path / "story.db"))
+    snapshots = ThreatSnapshotTable()
+    sessions = []
+    for text in ("An old story.", "A new story."):
+        session = store.create_session()
+        node = TreeNode(text, "Start")
+        store.add_node(session, node, snapshots)
+        store.set_head(session, node)
+        sessions.append(session)
+    old, new = sessions
+    store.delete_session(old)
+    store.flush()
+    for table, column in (("nodes", "session"), ("threat_snapshots", "session"), ("sessions", "id")):
+        assert store.reader.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} = ?", (old,)).fetchone()[0] == 0
+    assert store.latest_session() == new
+    store.close()
@@ -0,0 +1,51 @@
+import time
+
+import metrics
+from single_flight import CoalescingClient
+from story_tree import TreeNode
+from summarizer import RollingSummarizer
+from standin import make_client
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_empty_turn_passes_its_parents_summary_on(standins):
+    server = standins(text="The hero went on.")
+    summarizer = RollingSummarizer(make_client(server.url))
+    root = TreeNode("You stand in a dungeon.", "Start")
+    summarizer.submit(root)
+    assert wait_until(lambda: root.summary is not None)
+
+    # A defeat turn has no narration of its own.
+    defeat = TreeNode("", "I use fire", parent=root)
+    root.add_child(defeat)
+    node = defeat
+    for i in range(5):
+        child = TreeNode(f"Scene {i}", f"choice {i}")
+        node.add_child(child)
+        node = child
+    summarizer.submit(node)
+    assert wait_until(lambda: node.summary is not None)
+    assert defeat.summary is root.summary
+    assert all(turn.summary is not None for turn in node.path_nodes(defeat.depth + 1))
+    assert len(server.requests) == 6
+
+
+def test_pause_while_waiting_for_a_token_redoes_the_summary(standins):
+    server = standins(text="The hero went on.", first_token_delay=0.5)
+    summarizer = RollingSummarizer(CoalescingClient(make_client(server.url)))
+    root = TreeNode("You stand in a dungeon.", "Start")
+    summarizer.submit(root)
+    assert wait_until(lambda: len(server.requests) == 1)
+    summarizer.pause()
+    assert wait_until(lambda: metrics.get_counter("summaries_interrupted") == 1)
+    server.first_token_delay = 0
+    summarizer.resume()
+    assert wait_until(lambda: root.summary is not None)
+    assert metrics.get_counter("summary_failures") == 0
+    assert metrics.get_counter("summaries_built") == 1
@@ -1,6 +1,134 @@
 import random
 import json
 
+def threat_tier(threat_level):
+    if 1 <= threat_level <= 3:
+        return "low"
+    if 4 <= threat_level <= 6:
+        return "medium"
+    if 7 <= threat_level <= 9:
+        return "high"
+    return "danger"
+
+
+THREAT_GUIDANCE = {
+    "low": "Low threat (can fight easily)",
+    "medium": "Medium threat (fight at your own loss)",
+    "high": "High threat (avoid conflict)",
+    "danger": "Danger threat (run away at sight)",
+}
+
+
+class EnemyFragments:
+    # Prompt text for one enemy profile, rendered once when the registry loads.
+    def __init__(self, profile, enemy_types):
+        t = profile['type']
+        p = profile['template']
+        threat_level = p.get('threat_level', 0)
+        self.description = (
+            f"A {t} emerges from the shadows of the {p['domain']}!\n"
+            f"Threat Level: {p['threat_level']} ({THREAT_GUIDANCE[threat_tier(p['threat_level'])]})\n"
+            f"Domain: {p['domain']}\n"
+            f"Powers: {', '.join(p['powers'])}\n"
+            f"Weaknesses: {', '.join(p['weaknesses'])}\n"
+            f"Hint: {p.get('hint', 'No hint available.')}"
+        )
+        self.information = f"⚠️ Enemy Information:\n{self.description}\n\n"
+        # Domain, powers, weaknesses, hint and threat level already appear in the information
+        # section, so the instruction block only names the enemy.
+        self.enemy = (
+            f"Current Enemy: {t}\n"
+            f"You MUST select the current enemy ONLY from the following types: {', '.join(enemy_types)}. "
+            "Do NOT invent new enemies. Narrate the scene based on the player's last action, incorporating the enemy's domain, but do not resolve actions, suggest plans, or make decisions for the player. "
+            "Always end your response with three action options (e.g., 'What will you do? 1) Option A, 2) Option B, 3) Option C').\n\n"
+        )
+        self.death_rules = ""
+        if threat_level >= 10:
+            self.death_rules = (
+                " Player Death Rules:\n"
+                "- If the player does NOT flee (by using the word 'flee', 'run away', 'escape', or similar), you MUST kill them immediately.\n"
+                "- Any action involving fighting, dodging, blocking, or standing their ground must result in instant death.\n"
+                "- You MUST interpret all combat or hesitation as failure to flee. Do not be lenient.\n"
+            )
+        elif 7 <= threat_level <= 9:
+            self.death_rules = (
+                "🪦 Player Death Rules:\n"
+                "- The enemy is a **high-level threat (7-9)**. If the player does NOT use a listed weakness, they MUST die.\n"
+                "- You must describe the player's death vividly using language such as:\n"
+                "  'rips through your chest', 'slams you against the wall with a deafening crack', 'you die', 'your vision fades'.\n"
+                "- Only spare them if they cleverly use a weakness.\n"
+            )
+
+
+class EnemyRegistry:
+    def __init__(self, profiles):
+        self.profiles = profiles
+        enemy_types = list(dict.fromkeys(profile['type'] for profile in profiles))
+        self.fragments = {}
+        for profile in profiles:
+            key = (profile['type'], threat_tier(profile['template'].get('threat_level', 0)))
+            self.fragments[key] = EnemyFragments(profile, enemy_types)
+
+    def fragments_for(self, profile):
+        # Keyed by type and tier rather than identity: threat snapshots hold copies of the profile.
+        key = (profile['type'], threat_tier(profile['template'].get('threat_level', 0)))
+        fragments = self.fragments.get(key)
+        if fragments is None:
+            fragments = self.fragments[key] = EnemyFragments(profile, [profile['type']])
+        return fragments
+
+
+enemy_registries = {}
+
+
+def load_enemy_registry(file_path="enemies_type.json"):
+    registry = enemy_registries.get(file_path)
+    if registry is None:
+        with open(file_path, 'r') as file:
+            registry = enemy_registries[file_path] = EnemyRegistry(json.load(file))
+    return registry
+
+
+class ThreatSnapshotTable:
+    """Threat and memory states seen in one session, stored once and referenced from tree nodes by id."""
+
+    def __init__(self):
+        self.snapshots = []
+        self.ids = {}
+
+    def capture(self, threat_manager, memories=()):
+        # Taken once a turn has been applied, so moving to a node restores it directly. The turn
+        # counter moves every turn, so nodes keep it themselves and consecutive turns share one
+        # snapshot until a threat starts or ends or the memories change.
+        profile = threat_manager.enemy_profile
+        memories = tuple(sorted(memories))
+        key = (threat_manager.last_threat, threat_manager.enemy_revealed, threat_manager.enemy_defeated,
+               profile['type'] if profile else None, memories)
+        snapshot_id = self.ids.get(key)
+        if snapshot_id is None:
+            snapshot_id = self.ids[key] = len(self.snapshots)
+            self.snapshots.append((threat_manager.last_threat, threat_manager.enemy_revealed, profile,
+                                   threat_manager.enemy_defeated, memories))
+        return snapshot_id
+
+    def state_for(self, node):
+        if node.threat_id is None:
+            return None
+        last_threat, enemy_revealed, enemy_profile, enemy_defeated, _ = self.snapshots[node.threat_id]
+        return {
+            "turn_counter": node.turn_counter,
+            "last_threat": last_threat,
+            "enemy_revealed": enemy_revealed,
+            "enemy_profile": enemy_profile,
+            "enemy_defeated": enemy_defeated
+        }
+
+    def memories_for(self, node):
+        if node.threat_id is None:
+            return ()
+        return self.snapshots[node.threat_id][4]
+
+
 class ThreatManager:
     def __init__(self):
         self.turn_counter = 0
@@ -14,8 +142,15 @@ class ThreatManager:
 
 
     def load_enemies(self, file_path="enemies_type.json"):
-        with open(file_path, 'r') as file:
-            return json.load(file)
+        return load_enemy_registry(file_path).profiles
+
+    def restore(self, threat_state):
+        self.turn_counter = threat_state["turn_counter"]
+        self.last_threat = threat_state["last_threat"]
+        self.enemy_revealed = threat_state["enemy_revealed"]
+        self.enemy_profile = threat_state["enemy_profile"] or self.enemy_profile
+        self.enemy_defeated = threat_state["enemy_defeated"]
+        self.threat_history = []
 
     def advance_threat(self):
         if self.enemy_defeated:
@@ -84,22 +219,12 @@ class ThreatManager:
         if self.enemy_defeated:
             self.reset_threat()
 
+    def enemy_fragments(self):
+        if not self.enemy_profile:
+            return None
+        return load_enemy_registry().fragments_for(self.enemy_profile)
+
     def get_enemy_description(self):
         if not self.enemy_revealed or not self.enemy_profile:
             return ""
-        t = self.enemy_profile['type']
-        p = self.enemy_profile['template']
-        threat_guidance = (
-            "Low threat (can fight easily)" if 1 <= p['threat_level'] <= 3 else
-            "Medium threat (fight at your own loss)" if 4 <= p['threat_level'] <= 6 else
-            "High threat (avoid conflict)" if 7 <= p['threat_level'] <= 9 else
-            "Danger threat (run away at sight)"
-        )
-        return (
-            f"A {t} emerges from the shadows of the {p['domain']}!\n"
-            f"Threat Level: {p['threat_level']} ({threat_guidance})\n"
-            f"Domain: {p['domain']}\n"
-            f"Powers: {', '.join(p['powers'])}\n"
-            f"Weaknesses: {', '.join(p['weaknesses'])}\n"
-            f"Hint: {p.get('hint', 'No hint available.')}"
-        )
\ No newline at end of file
+        return self.enemy_fragments().description